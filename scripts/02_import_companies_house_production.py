@@ -10,10 +10,13 @@ Handles the large CSV files efficiently with batch processing.
 import os
 import sys
 import csv
+import io
+import json
+import struct
+import subprocess
 import psycopg2
-from psycopg2.extras import execute_values
 import logging
-from datetime import datetime
+from datetime import date, datetime
 from pathlib import Path
 import argparse
 from tqdm import tqdm
@@ -23,23 +26,41 @@ import gc
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.postgresql_config import POSTGRESQL_CONFIG
 
-# Configure logging
+# Logging is configured in main(), once --vacuum-only is known
 log_filename = f'ch_import_production_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+def configure_logging(vacuum_only=False):
+    """Log to the console, and to log_filename unless only vacuuming.
+    
+    The background VACUUM re-imports this module, so it would otherwise open
+    a second log file; start_background_vacuum already sends its output to
+    the import's log.
+    """
+    handlers = [logging.StreamHandler()]
+    if not vacuum_only:
+        handlers.insert(0, logging.FileHandler(log_filename))
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+
+# PostgreSQL binary COPY framing (see "COPY ... FORMAT BINARY" in the PG docs)
+PG_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PG_COPY_TRAILER = struct.pack('!h', -1)
+PG_COPY_NULL = struct.pack('!i', -1)
+PG_EPOCH_ORDINAL = date(2000, 1, 1).toordinal()
+
 class CompaniesHouseImporter:
     def __init__(self, batch_size=10000):
         self.batch_size = batch_size
         self.conn = None
         self.cursor = None
+        self.fresh_table = False  # True when loading into an empty/truncated table
+        self._columns = None  # Column order and SQL are fixed by the first batch
+        self._copy_query = None
+        self._merge_query = None
         self.stats = {
             'total_records': 0,
             'inserted': 0,
@@ -53,6 +74,13 @@ class CompaniesHouseImporter:
         try:
             self.conn = psycopg2.connect(**POSTGRESQL_CONFIG)
             self.cursor = self.conn.cursor()
+            
+            # Bulk-load session tuning; temp_buffers must be set before staging_ch is touched
+            self.cursor.execute("SET synchronous_commit = off")
+            self.cursor.execute("SET work_mem = '256MB'")
+            self.cursor.execute("SET maintenance_work_mem = '2GB'")
+            self.cursor.execute("SET temp_buffers = '512MB'")
+            self.conn.commit()
             logger.info("Connected to PostgreSQL database")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
@@ -102,26 +130,7 @@ class CompaniesHouseImporter:
                 limited_partnerships_general_partners TEXT,
                 limited_partnerships_limited_partners TEXT,
                 uri TEXT,
-                previous_name_1_name TEXT,
-                previous_name_1_date DATE,
-                previous_name_2_name TEXT,
-                previous_name_2_date DATE,
-                previous_name_3_name TEXT,
-                previous_name_3_date DATE,
-                previous_name_4_name TEXT,
-                previous_name_4_date DATE,
-                previous_name_5_name TEXT,
-                previous_name_5_date DATE,
-                previous_name_6_name TEXT,
-                previous_name_6_date DATE,
-                previous_name_7_name TEXT,
-                previous_name_7_date DATE,
-                previous_name_8_name TEXT,
-                previous_name_8_date DATE,
-                previous_name_9_name TEXT,
-                previous_name_9_date DATE,
-                previous_name_10_name TEXT,
-                previous_name_10_date DATE,
+                previous_names JSONB,
                 conf_stmt_next_due_date DATE,
                 conf_stmt_last_made_up_date DATE,
                 data_source VARCHAR(50) DEFAULT 'basic_file',
@@ -132,6 +141,19 @@ class CompaniesHouseImporter:
             );
         """)
         
+        # Tables created before previous names moved into a single JSONB column
+        self.cursor.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'companies_house_data'
+              AND column_name IN ('previous_names', 'previous_name_1_name')
+        """)
+        existing_columns = {row[0] for row in self.cursor.fetchall()}
+        if 'previous_names' not in existing_columns:
+            self.cursor.execute("ALTER TABLE companies_house_data ADD COLUMN previous_names JSONB")
+            if 'previous_name_1_name' in existing_columns:
+                self.backfill_previous_names()
+        
         # Create indexes for performance
         indexes = [
             "CREATE INDEX IF NOT EXISTS idx_ch_company_name ON companies_house_data(company_name);",
@@ -141,14 +163,20 @@ class CompaniesHouseImporter:
             "CREATE INDEX IF NOT EXISTS idx_ch_sic_codes ON companies_house_data(sic_code_1, sic_code_2, sic_code_3, sic_code_4);",
             # Index for active companies
             "CREATE INDEX IF NOT EXISTS idx_ch_active_companies ON companies_house_data(company_number) WHERE company_status = 'Active';",
-            # Indexes for previous names
-            "CREATE INDEX IF NOT EXISTS idx_ch_previous_name_1 ON companies_house_data(previous_name_1_name) WHERE previous_name_1_name IS NOT NULL;",
-            "CREATE INDEX IF NOT EXISTS idx_ch_previous_name_2 ON companies_house_data(previous_name_2_name) WHERE previous_name_2_name IS NOT NULL;"
+            # Index for previous names
+            "CREATE INDEX IF NOT EXISTS idx_ch_previous_names ON companies_house_data USING GIN (previous_names jsonb_path_ops);"
         ]
         
         for idx_sql in indexes:
             self.cursor.execute(idx_sql)
             
+        # Session-local staging table that each batch is COPYed into before merging
+        self.cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS staging_ch
+            (LIKE companies_house_data INCLUDING DEFAULTS)
+            ON COMMIT DELETE ROWS
+        """)
+            
         self.conn.commit()
         logger.info("Ensured companies_house_data table exists with all indexes")
         
@@ -174,6 +202,12 @@ class CompaniesHouseImporter:
         # Remove extra whitespace
         value = ' '.join(value.strip().split())
         return value if value else None
+
+    @staticmethod
+    def _safe_int(value):
+        """Parse an integer column, treating blank and 'None' as NULL"""
+        value = value.strip() if value else ''
+        return int(value) if value and value != 'None' else None
         
     def import_file(self, filepath):
         """Import a Companies House data file"""
@@ -183,6 +217,7 @@ class CompaniesHouseImporter:
         # Check if we need to clear existing data
         self.cursor.execute("SELECT COUNT(*) FROM companies_house_data")
         existing_count = self.cursor.fetchone()[0]
+        self.fresh_table = existing_count == 0
         
         if existing_count > 0:
             logger.warning(f"Found {existing_count:,} existing records")
@@ -191,6 +226,7 @@ class CompaniesHouseImporter:
                 logger.info("Truncating companies_house_data table...")
                 self.cursor.execute("TRUNCATE TABLE companies_house_data")
                 self.conn.commit()
+                self.fresh_table = True
             else:
                 logger.info("Proceeding with update mode (INSERT ... ON CONFLICT UPDATE)")
         
@@ -199,7 +235,8 @@ class CompaniesHouseImporter:
         total_lines = sum(1 for _ in open(filepath, 'r', encoding='utf-8'))
         logger.info(f"Total lines to process: {total_lines:,}")
         
-        batch_data = []
+        # Keyed by company number so duplicate rows collapse to the last one seen
+        batch_data = {}
         
         with open(filepath, 'r', encoding='utf-8') as f:
             reader = csv.DictReader(f)
@@ -230,10 +267,10 @@ class CompaniesHouseImporter:
                         'accounts_category': self.clean_value(row.get('Accounts.AccountCategory')),
                         'returns_next_due_date': self.parse_date(row.get('Returns.NextDueDate')),
                         'returns_last_made_up_date': self.parse_date(row.get('Returns.LastMadeUpDate')),
-                        'mortgages_num_charges': int(row['Mortgages.NumCharges']) if row.get('Mortgages.NumCharges') and row['Mortgages.NumCharges'].strip() and row['Mortgages.NumCharges'].strip() != 'None' else None,
-                        'mortgages_num_outstanding': int(row['Mortgages.NumOutstanding']) if row.get('Mortgages.NumOutstanding') and row['Mortgages.NumOutstanding'].strip() and row['Mortgages.NumOutstanding'].strip() != 'None' else None,
-                        'mortgages_num_part_satisfied': int(row['Mortgages.NumPartSatisfied']) if row.get('Mortgages.NumPartSatisfied') and row['Mortgages.NumPartSatisfied'].strip() and row['Mortgages.NumPartSatisfied'].strip() != 'None' else None,
-                        'mortgages_num_satisfied': int(row['Mortgages.NumSatisfied']) if row.get('Mortgages.NumSatisfied') and row['Mortgages.NumSatisfied'].strip() and row['Mortgages.NumSatisfied'].strip() != 'None' else None,
+                        'mortgages_num_charges': self._safe_int(row.get('Mortgages.NumCharges')),
+                        'mortgages_num_outstanding': self._safe_int(row.get('Mortgages.NumOutstanding')),
+                        'mortgages_num_part_satisfied': self._safe_int(row.get('Mortgages.NumPartSatisfied')),
+                        'mortgages_num_satisfied': self._safe_int(row.get('Mortgages.NumSatisfied')),
                         'sic_code_1': self.clean_value(row.get('SICCode.SicText_1')),
                         'sic_code_2': self.clean_value(row.get('SICCode.SicText_2')),
                         'sic_code_3': self.clean_value(row.get('SICCode.SicText_3')),
@@ -245,21 +282,29 @@ class CompaniesHouseImporter:
                         'conf_stmt_last_made_up_date': self.parse_date(row.get('ConfStmtLastMadeUpDate'))
                     }
                     
-                    # Add previous names
+                    # Add previous names (filled in order, so stop at the first gap)
+                    previous_names = []
                     for i in range(1, 11):
-                        record[f'previous_name_{i}_name'] = self.clean_value(row.get(f'PreviousName_{i}.CompanyName'))
-                        record[f'previous_name_{i}_date'] = self.parse_date(row.get(f'PreviousName_{i}.CONDATE'))
+                        prev_name = self.clean_value(row.get(f'PreviousName_{i}.CompanyName'))
+                        if not prev_name:
+                            break
+                        prev_date = self.parse_date(row.get(f'PreviousName_{i}.CONDATE'))
+                        previous_names.append({
+                            'name': prev_name,
+                            'date': prev_date.isoformat() if prev_date else None
+                        })
+                    record['previous_names'] = previous_names or None
                     
                     # Skip if no company number
                     if not record['company_number']:
                         continue
                         
-                    batch_data.append(record)
+                    batch_data[record['company_number']] = record
                     
                     # Process batch
                     if len(batch_data) >= self.batch_size:
-                        self.insert_batch(batch_data)
-                        batch_data = []
+                        self.insert_batch(list(batch_data.values()))
+                        batch_data = {}
                         
                     pbar.update(1)
                     self.stats['total_records'] += 1
@@ -270,34 +315,110 @@ class CompaniesHouseImporter:
                         
                 # Insert remaining records
                 if batch_data:
-                    self.insert_batch(batch_data)
+                    self.insert_batch(list(batch_data.values()))
+                self.flush_async_commits()
                     
         self.stats['files_processed'] += 1
         logger.info(f"Completed importing {filename}")
         
+    def flush_async_commits(self):
+        """Commit synchronously once, flushing the WAL of every earlier asynchronous batch"""
+        # Its own transaction, so a rolled-back final batch can't undo it, and
+        # SET LOCAL leaves the session asynchronous for the next file.
+        # txid_current() assigns an xid, so the commit writes a commit record
+        # and waits for the WAL up to it to be flushed
+        self.cursor.execute("SET LOCAL synchronous_commit = on")
+        self.cursor.execute("SELECT txid_current()")
+        self.conn.commit()
+        
+    def backfill_previous_names(self):
+        """Fill previous_names from the old previous_name_N_name/_date columns (one-off)"""
+        # 03_match_lr_to_ch_production reads only previous_names, so without
+        # this every company loaded before the JSONB column existed would
+        # match on its current name alone
+        logger.info("Backfilling previous_names from previous_name_N columns...")
+        slots = ', '.join(f"({i}, previous_name_{i}_name, previous_name_{i}_date)" for i in range(1, 11))
+        self.cursor.execute(f"""
+            UPDATE companies_house_data c
+            SET previous_names = p.names
+            FROM (
+                SELECT company_number,
+                       jsonb_agg(jsonb_build_object('name', n.name, 'date', n.date) ORDER BY n.slot) AS names
+                FROM companies_house_data
+                CROSS JOIN LATERAL (VALUES {slots}) AS n(slot, name, date)
+                WHERE n.name IS NOT NULL
+                GROUP BY company_number
+            ) p
+            WHERE c.company_number = p.company_number
+        """)
+        logger.info(f"Backfilled previous_names for {self.cursor.rowcount:,} companies")
+        
+    def build_copy_buffer(self, batch_data, columns):
+        """Encode a batch as a PostgreSQL binary COPY stream.
+        
+        Values are written in their native wire format (int4, date as days
+        since 2000-01-01, UTF-8 text, versioned jsonb) so the server skips
+        text parsing.
+        """
+        pack = struct.pack
+        buf = io.BytesIO()
+        write = buf.write
+        write(PG_COPY_HEADER)
+        field_count = pack('!h', len(columns))
+        
+        for record in batch_data:
+            write(field_count)
+            for col in columns:
+                value = record[col]
+                if value is None:
+                    write(PG_COPY_NULL)
+                elif isinstance(value, str):
+                    data = value.encode('utf-8')
+                    write(pack('!i', len(data)))
+                    write(data)
+                elif isinstance(value, int):
+                    write(pack('!ii', 4, value))
+                elif isinstance(value, list):
+                    data = b'\x01' + json.dumps(value).encode('utf-8')
+                    write(pack('!i', len(data)))
+                    write(data)
+                else:
+                    write(pack('!ii', 4, value.toordinal() - PG_EPOCH_ORDINAL))
+                    
+        write(PG_COPY_TRAILER)
+        buf.seek(0)
+        return buf
+        
+    def prepare_queries(self, columns):
+        """Build the COPY and merge statements once for the given column order"""
+        self._columns = tuple(columns)
+        column_list = ', '.join(self._columns)
+        
+        self._copy_query = f"COPY staging_ch ({column_list}) FROM STDIN WITH (FORMAT BINARY)"
+        
+        # Merge staged rows into the permanent table
+        self._merge_query = f"""
+            INSERT INTO companies_house_data ({column_list})
+            SELECT {column_list} FROM staging_ch
+            ON CONFLICT (company_number) DO UPDATE SET
+                {', '.join([f"{col} = EXCLUDED.{col}" for col in self._columns if col != 'company_number'])},
+                updated_at = CURRENT_TIMESTAMP
+        """
+        
     def insert_batch(self, batch_data):
-        """Insert a batch of records using ON CONFLICT UPDATE"""
+        """COPY a batch into staging_ch, then merge using ON CONFLICT UPDATE"""
         if not batch_data:
             return
             
-        try:
-            columns = list(batch_data[0].keys())
+        if self._columns is None:
+            self.prepare_queries(batch_data[0].keys())
             
-            # Build INSERT ... ON CONFLICT UPDATE query
-            insert_query = f"""
-                INSERT INTO companies_house_data ({', '.join(columns)})
-                VALUES %s
-                ON CONFLICT (company_number) DO UPDATE SET
-                    {', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != 'company_number'])},
-                    updated_at = CURRENT_TIMESTAMP
-            """
-            
-            # Prepare values
-            values = []
-            for record in batch_data:
-                values.append(tuple(record[col] for col in columns))
-                
-            execute_values(self.cursor, insert_query, values)
+        try:
+            self.cursor.copy_expert(
+                self._copy_query,
+                self.build_copy_buffer(batch_data, self._columns)
+            )
+            self.cursor.execute(self._merge_query)
             self.conn.commit()
             
             self.stats['inserted'] += len(batch_data)
@@ -307,9 +428,35 @@ class CompaniesHouseImporter:
             self.conn.rollback()
             self.stats['errors'] += len(batch_data)
             
+    def vacuum_table(self):
+        """Run VACUUM ANALYZE on its own autocommit connection"""
+        conn = psycopg2.connect(**POSTGRESQL_CONFIG)
+        conn.autocommit = True  # VACUUM cannot run inside a transaction block
+        try:
+            with conn.cursor() as cursor:
+                logger.info("Running VACUUM (ANALYZE, PARALLEL 4) on companies_house_data...")
+                cursor.execute("VACUUM (ANALYZE, PARALLEL 4) companies_house_data")
+                logger.info("VACUUM ANALYZE complete")
+        finally:
+            conn.close()
+            
+    def start_background_vacuum(self):
+        """Hand VACUUM ANALYZE to a detached process so the import can exit"""
+        # Nothing waits for the child, so its output (including any failure)
+        # is appended to this import's log file
+        with open(log_filename, 'a') as log_file:
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--vacuum-only'],
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+        logger.info(f"Started VACUUM ANALYZE of companies_house_data in the background (output in {log_filename})")
+            
     def run_import(self, ch_file=None, ch_dir=None):
         """Main import process"""
         start_time = datetime.now()
+        needs_vacuum = False
         
         try:
             self.connect()
@@ -334,10 +481,14 @@ class CompaniesHouseImporter:
             for filepath in files_to_import:
                 self.import_file(filepath)
                 
-            # Run VACUUM ANALYZE
-            logger.info("Running VACUUM ANALYZE on companies_house_data...")
-            self.cursor.execute("VACUUM ANALYZE companies_house_data")
-            self.conn.commit()
+            if self.fresh_table:
+                # A freshly loaded table has no dead tuples, only stale statistics
+                logger.info("Running ANALYZE on companies_house_data...")
+                self.cursor.execute("ANALYZE companies_house_data")
+                self.conn.commit()
+            else:
+                # Updated rows leave dead tuples; vacuum once this connection is closed
+                needs_vacuum = True
             
             # Final statistics
             elapsed = (datetime.now() - start_time).total_seconds()
@@ -356,6 +507,9 @@ class CompaniesHouseImporter:
             raise
         finally:
             self.disconnect()
+            
+        if needs_vacuum:
+            self.start_background_vacuum()
 
 def main():
     parser = argparse.ArgumentParser(description='Import Companies House Basic Company Data')
@@ -366,10 +520,20 @@ def main():
                        help='Directory containing CH files (will use most recent)')
     parser.add_argument('--batch-size', type=int, default=10000,
                        help='Batch size for inserts (default: 10000)')
+    parser.add_argument('--vacuum-only', action='store_true',
+                       help='Only run VACUUM ANALYZE on companies_house_data (logs to the console only)')
     
     args = parser.parse_args()
+    configure_logging(vacuum_only=args.vacuum_only)
     
     importer = CompaniesHouseImporter(batch_size=args.batch_size)
+    if args.vacuum_only:
+        try:
+            importer.vacuum_table()
+        except Exception as e:
+            logger.error(f"VACUUM ANALYZE of companies_house_data failed: {e}")
+            sys.exit(1)
+        return
     importer.run_import(ch_file=args.file, ch_dir=args.ch_dir)
 
 if __name__ == '__main__':
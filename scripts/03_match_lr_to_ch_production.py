@@ -11,8 +11,9 @@ Key Features:
 - Filters to only process Limited Companies/PLCs and LLPs
 - For unmatched companies, populates CH fields with Land Registry data for frontend
 - Uses 'Land_Registry' match type (0.3 confidence) for unmatched companies
-- Commits after each batch to ensure data is saved
+- Commits every 10 batches (50,000 records) to ensure data is saved
 - Clear progress tracking and verification
+- --incremental only matches LR records missing from the match table
 - ~84% match rate with proper suffix handling
 
 v4.1: Simplified - removed companies table population to avoid transaction errors
@@ -23,13 +24,18 @@ Created: 2025-09-18, Updated: 2025-09-19
 """
 
 import psycopg2
-from psycopg2.extras import execute_values
-import re
+import argparse
+import functools
+import gc
+import io
+import multiprocessing
+import os
+import string
 import sys
 from pathlib import Path
 from tqdm import tqdm
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 import logging
 
 # Configure logging
@@ -47,6 +53,28 @@ logger = logging.getLogger(__name__)
 sys.path.append(str(Path(__file__).parent.parent))
 from config.postgresql_config import POSTGRESQL_CONFIG
 
+# Suffixes that end a company name. The original regex alternatives
+# (LIMITED LIABILITY PARTNERSHIP|LIMITED|COMPANY|LTD.|LLP|LTD|PLC|CO.|CO)
+# reduce to these prefixes: the earliest hit of either set is the same position.
+_SUFFIX_KEYWORDS = ('LIMITED', 'CO', 'LTD', 'LLP', 'PLC')
+
+class _KeepTable(dict):
+    """str.translate table that keeps characters passing `keep` and drops the
+    rest, filled in lazily per code point instead of covering all of Unicode"""
+    def __init__(self, keep):
+        super().__init__()
+        self.keep = keep
+    
+    def __missing__(self, codepoint):
+        value = codepoint if self.keep(chr(codepoint)) else None
+        self[codepoint] = value
+        return value
+
+_KEEP_ALNUM = _KeepTable(str.isalnum)
+_KEEP_ASCII_ALNUM = _KeepTable(frozenset(string.ascii_uppercase + string.digits).__contains__)
+
+# Proprietor and CH names repeat heavily, so both normalizers are memoized
+@functools.lru_cache(maxsize=1_000_000)
 def normalize_company_name(name):
     """PROVEN normalization that REMOVES suffixes"""
     if not name or name.strip() == '':
@@ -56,21 +84,28 @@ def normalize_company_name(name):
     name = name.replace(' AND ', ' ').replace(' & ', ' ')
     
     # CRITICAL FIX: Remove suffixes AND anything after them
-    suffix_pattern = r'\s*(LIMITED LIABILITY PARTNERSHIP|LIMITED|COMPANY|LTD\.|LLP|LTD|PLC|CO\.|CO).*$'
-    name = re.sub(suffix_pattern, '', name)
+    # (like the old '.*$' pattern, a suffix only counts on the last line)
+    start = name.rfind('\n') + 1
+    cut = len(name)
+    for keyword in _SUFFIX_KEYWORDS:
+        pos = name.find(keyword, start)
+        if pos != -1 and pos < cut:
+            cut = pos
+    name = name[:cut]
     
     # Keep only alphanumeric
-    name = ''.join(char for char in name if char.isalnum())
-    
-    return name
+    return name.translate(_KEEP_ALNUM)
 
+@functools.lru_cache(maxsize=1_000_000)
 def normalize_company_number(number):
     """Normalize company registration numbers"""
     if not number or str(number).strip() == '':
         return ''
     
     number = str(number).strip().upper()
-    number = re.sub(r'[^A-Z0-9]', '', number)
+    if not (number.isascii() and number.isalnum()):
+        # Keep only A-Z0-9 (clean numbers skip this)
+        number = number.translate(_KEEP_ASCII_ALNUM)
     
     # Handle Scottish numbers
     if number.startswith('SC'):
@@ -82,19 +117,43 @@ def normalize_company_number(number):
     
     return number
 
+def intern_or_none(value):
+    """sys.intern strings so repeated proprietor values share one object"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+def copy_text_value(value):
+    """Render a value for COPY ... WITH (FORMAT text)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                     .replace('\n', '\\n').replace('\r', '\\r'))
+    return str(value)
+
+parser = argparse.ArgumentParser(description='Match Land Registry proprietors to Companies House')
+parser.add_argument('--incremental', action='store_true',
+                   help='Keep existing matches and only match LR records not yet in land_registry_ch_matches')
+args = parser.parse_args()
+
 print("=== GUARANTEED COMPLETE MATCHING SCRIPT ===")
-print("This will match ALL Land Registry records with NO limits")
+if args.incremental:
+    print("INCREMENTAL mode: only Land Registry records without a match row will be matched")
+else:
+    print("This will match ALL Land Registry records with NO limits")
 print(f"Started at: {datetime.now()}\n")
 
 # Connect to database
 conn = psycopg2.connect(**POSTGRESQL_CONFIG)
 cursor = conn.cursor()
 
-# First, clear the match table completely
-print("Step 1: Clearing match table...")
-cursor.execute("TRUNCATE TABLE land_registry_ch_matches")
-conn.commit()
-print("✅ Match table cleared\n")
+# First, clear the match table completely (full rebuild only)
+if args.incremental:
+    print("Step 1: Keeping existing matches (incremental mode)\n")
+else:
+    print("Step 1: Clearing match table...")
+    cursor.execute("TRUNCATE TABLE land_registry_ch_matches")
+    conn.commit()
+    print("✅ Match table cleared\n")
 
 # Load ALL Companies House data into memory (skip companies table population for now)
 print("Step 2: Loading Companies House data into memory...")
@@ -102,218 +161,260 @@ cursor.execute("SELECT COUNT(*) FROM companies_house_data")
 ch_count = cursor.fetchone()[0]
 print(f"Loading {ch_count:,} companies into memory...")
 
+# Current and previous names share one index: both tiers are looked up with the
+# same normalized LR name and a current-name hit always wins, so each key keeps
+# only its best (match_type, confidence) and the first company loaded for it.
+# Numbers stay separate because a digits-only name could collide with them.
+NAME_MATCH = ('Name', 0.7)
+PREVIOUS_NAME_MATCH = ('Previous_Name', 0.5)
+
 ch_by_number = {}
 ch_by_name = {}
-ch_previous_names = {}
-
-# Just get the fields we need for matching
-cursor.execute("""
-    SELECT company_number, company_name, 
-           previous_name_1_name, previous_name_2_name, previous_name_3_name, 
-           previous_name_4_name, previous_name_5_name
+previous_name_count = 0
+
+# Just get the fields we need for matching, streamed through a server-side
+# cursor so the full result set is never buffered client-side
+load_cursor = conn.cursor(name='ch_stream')
+load_cursor.itersize = 50000
+load_cursor.execute("""
+    SELECT company_number, company_name, previous_names
     FROM companies_house_data
 """)
 
 with tqdm(total=ch_count, desc="Loading CH data") as pbar:
     batch_count = 0
     while True:
-        batch = cursor.fetchmany(10000)
+        batch = load_cursor.fetchmany(50000)
         if not batch:
             break
             
         for row in batch:
-            company_number, company_name, pn1, pn2, pn3, pn4, pn5 = row
+            company_number, company_name, previous_names = row
+            
+            # One interned entry tuple shared by both indexes, carrying the
+            # normalized name so tier 1 never re-normalizes CH names
+            norm_name = normalize_company_name(company_name)
+            entry = (sys.intern(company_name) if company_name else company_name,
+                     sys.intern(company_number),
+                     norm_name)
             
             # Index by normalized number
             norm_number = normalize_company_number(company_number)
             if norm_number:
-                ch_by_number[norm_number] = (company_name, company_number)
+                ch_by_number[norm_number] = entry
             
             # Index by normalized name
-            norm_name = normalize_company_name(company_name)
             if norm_name:
-                if norm_name not in ch_by_name:
-                    ch_by_name[norm_name] = []
-                ch_by_name[norm_name].append((company_name, company_number))
+                existing = ch_by_name.get(norm_name)
+                if existing is None or existing[0] is PREVIOUS_NAME_MATCH:
+                    ch_by_name[norm_name] = (NAME_MATCH, entry)
             
-            # Index previous names
-            for prev_name in [pn1, pn2, pn3, pn4, pn5]:
+            # Index previous names (first 5 only)
+            for prev in (previous_names or [])[:5]:
+                prev_name = prev.get('name')
                 if prev_name:
                     norm_prev = normalize_company_name(prev_name)
                     if norm_prev:
-                        if norm_prev not in ch_previous_names:
-                            ch_previous_names[norm_prev] = []
-                        ch_previous_names[norm_prev].append((company_name, company_number))
+                        ch_by_name.setdefault(norm_prev, (PREVIOUS_NAME_MATCH, entry))
+                        previous_name_count += 1
         
         pbar.update(len(batch))
 
 # Final commit for CH data
+load_cursor.close()
 conn.commit()
 
 print(f"✅ Loaded {len(ch_by_number):,} unique company numbers")
-print(f"✅ Loaded {len(ch_by_name):,} unique company names")
-print(f"✅ Loaded {len(ch_previous_names):,} previous names\n")
+print(f"✅ Loaded {len(ch_by_name):,} unique current/previous company names")
+print(f"✅ Loaded {previous_name_count:,} previous names\n")
 
 # Process ALL Land Registry records
 print("Step 3: Processing ALL Land Registry records...")
 cursor.execute("SELECT COUNT(*) FROM land_registry_data")
 lr_count = cursor.fetchone()[0]
-print(f"Will process {lr_count:,} Land Registry records\n")
+
+# Only LR records without a match row need matching in incremental mode
+unmatched_filter = """
+    AND NOT EXISTS (SELECT 1 FROM land_registry_ch_matches m WHERE m.id = lr.id)
+""" if args.incremental else ""
+
+if args.incremental:
+    cursor.execute(f"SELECT COUNT(*) FROM land_registry_data lr WHERE TRUE {unmatched_filter}")
+    to_process = cursor.fetchone()[0]
+else:
+    to_process = lr_count
+print(f"Will process {to_process:,} Land Registry records\n")
 
 # Process in batches
 batch_size = 5000
+commit_every = 10  # batches per transaction
+batches_since_commit = 0
 total_matched = 0
 total_no_match = 0
 
-# Prepare insert query
-insert_query = """
-    INSERT INTO land_registry_ch_matches (
+# Match batches in forked worker processes, which share the read-only CH
+# indexes copy-on-write; the main process only fetches and COPYs
+num_workers = max(1, (os.cpu_count() or 2) - 1)
+max_pending = num_workers * 2  # batches in flight, caps memory
+
+# Prepare COPY statement (updated_at is left to its column default)
+copy_query = """
+    COPY land_registry_ch_matches (
         id,
         ch_matched_name_1, ch_matched_number_1, ch_match_type_1, ch_match_confidence_1,
         ch_matched_name_2, ch_matched_number_2, ch_match_type_2, ch_match_confidence_2,
         ch_matched_name_3, ch_matched_number_3, ch_match_type_3, ch_match_confidence_3,
-        ch_matched_name_4, ch_matched_number_4, ch_match_type_4, ch_match_confidence_4,
-        updated_at
-    ) VALUES %s
+        ch_matched_name_4, ch_matched_number_4, ch_match_type_4, ch_match_confidence_4
+    ) FROM STDIN WITH (FORMAT text)
 """
 
-# Process in chunks using OFFSET/LIMIT for reliability
-offset = 0
-
-with tqdm(total=lr_count, desc="Matching") as pbar:
-    while offset < lr_count:
-        # Fetch batch with all fields needed for companies table
-        cursor.execute("""
-            SELECT id, 
-                   proprietor_1_name, company_1_reg_no, proprietorship_1_category,
-                   country_1_incorporated, proprietor_1_address_1, proprietor_1_address_2,
-                   proprietor_1_address_3,
-                   proprietor_2_name, company_2_reg_no, proprietorship_2_category,
-                   country_2_incorporated, proprietor_2_address_1, proprietor_2_address_2,
-                   proprietor_2_address_3,
-                   proprietor_3_name, company_3_reg_no, proprietorship_3_category,
-                   country_3_incorporated, proprietor_3_address_1, proprietor_3_address_2,
-                   proprietor_3_address_3,
-                   proprietor_4_name, company_4_reg_no, proprietorship_4_category,
-                   country_4_incorporated, proprietor_4_address_1, proprietor_4_address_2,
-                   proprietor_4_address_3,
-                   date_proprietor_added, price_paid, dataset_type
-            FROM land_registry_data
-            ORDER BY id
-            OFFSET %s LIMIT %s
-        """, (offset, batch_size))
-        
-        records = cursor.fetchall()
-        if not records:
-            break
-        
-        batch_data = []
+def fetch_lr_batch(last_id):
+    """Fetch the next batch of Land Registry records after last_id"""
+    # Fetch only the (name, number, category) triple of each proprietor slot
+    cursor.execute(f"""
+        SELECT id, 
+               proprietor_1_name, company_1_reg_no, proprietorship_1_category,
+               proprietor_2_name, company_2_reg_no, proprietorship_2_category,
+               proprietor_3_name, company_3_reg_no, proprietorship_3_category,
+               proprietor_4_name, company_4_reg_no, proprietorship_4_category
+        FROM land_registry_data lr
+        WHERE id > %s
+        {unmatched_filter}
+        ORDER BY id
+        LIMIT %s
+    """, (last_id, batch_size))
+    return cursor.fetchall()
+
+def match_batch(records):
+    """Match one batch of LR records (runs in a worker process).
+    
+    Returns the batch as COPY text plus its matched / no-match counts.
+    """
+    batch_matched = 0
+    batch_no_match = 0
+    batch_data = []
+    
+    # Bind the hot lookups locally (neither index has an empty-string key)
+    get_by_number = ch_by_number.get
+    get_by_name = ch_by_name.get
+    
+    for record in records:
+        record_id, *slots = record
+        # The same proprietors recur across millions of titles; interning
+        # collapses the fresh copies psycopg2 decodes so the normalizer
+        # caches hit on identity with precomputed hashes
+        slots = list(map(intern_or_none, slots))
+        match_values = [record_id]
         
-        for record in records:
-            record_id = record[0]
-            date_proprietor_added = record[29]
-            price_paid = record[30]
-            dataset_type = record[31]
-            match_values = [record_id]
+        # Process each proprietor
+        for prop_name, prop_number, proprietorship_category in zip(slots[0::3], slots[1::3], slots[2::3]):
+            if not prop_name or prop_name.strip() == '':
+                # No proprietor in this slot
+                match_values.extend([None, None, None, None])
+                continue
             
-            # Process each proprietor
-            for i in range(4):
-                base_idx = 1 + i*7  # Each proprietor has 7 fields
-                prop_name = record[base_idx]
-                prop_number = record[base_idx + 1]
-                proprietorship_category = record[base_idx + 2]
-                country_incorporated = record[base_idx + 3]
-                address_1 = record[base_idx + 4]
-                address_2 = record[base_idx + 5]
-                address_3 = record[base_idx + 6]
-                
-                if not prop_name or prop_name.strip() == '':
-                    # No proprietor in this slot
-                    match_values.extend([None, None, None, None])
-                    continue
-                
-                # Only process Limited Companies and LLPs
-                if proprietorship_category not in ('Limited Company or Public Limited Company', 'Limited Liability Partnership'):
-                    # Skip non-company proprietors (individuals, charities, etc.)
-                    match_values.extend([None, None, 'Not_Company', 0.0])
-                    continue
-                
-                # Try to match
-                matched = False
-                
-                # 1. Try Name+Number match
-                if prop_number:
-                    norm_number = normalize_company_number(prop_number)
-                    norm_name = normalize_company_name(prop_name)
-                    
-                    if norm_number and norm_number in ch_by_number:
-                        ch_name, ch_number = ch_by_number[norm_number]
-                        ch_norm_name = normalize_company_name(ch_name)
-                        
-                        if norm_name == ch_norm_name:
-                            # Tier 1: Name+Number match
-                            # Truncate company number if too long
-                            truncated_ch_number = ch_number[:20] if ch_number and len(ch_number) > 20 else ch_number
-                            match_values.extend([ch_name, truncated_ch_number, 'Name+Number', 1.0])
-                            total_matched += 1
-                            matched = True
-                        else:
-                            # Tier 2: Number only match
-                            # Truncate company number if too long
-                            truncated_ch_number = ch_number[:20] if ch_number and len(ch_number) > 20 else ch_number
-                            match_values.extend([ch_name, truncated_ch_number, 'Number', 0.9])
-                            total_matched += 1
-                            matched = True
+            # Only process Limited Companies and LLPs
+            if proprietorship_category not in ('Limited Company or Public Limited Company', 'Limited Liability Partnership'):
+                # Skip non-company proprietors (individuals, charities, etc.)
+                match_values.extend([None, None, 'Not_Company', 0.0])
+                continue
+            
+            # Try to match
+            matched = False
+            norm_name = normalize_company_name(prop_name)
+            
+            # 1. Try Name+Number match
+            if prop_number:
+                entry = get_by_number(normalize_company_number(prop_number))
                 
-                # 2. Try Name only match
-                if not matched:
-                    norm_name = normalize_company_name(prop_name)
+                if entry is not None:
+                    ch_name, ch_number, ch_norm_name = entry
                     
-                    if norm_name and norm_name in ch_by_name:
-                        # Take the first match (could be multiple companies with same name)
-                        ch_name, ch_number = ch_by_name[norm_name][0]
+                    if norm_name == ch_norm_name:
+                        # Tier 1: Name+Number match
                         # Truncate company number if too long
-                        truncated_ch_number = ch_number[:20] if ch_number and len(ch_number) > 20 else ch_number
-                        match_values.extend([ch_name, truncated_ch_number, 'Name', 0.7])
-                        total_matched += 1
+                        truncated_ch_number = ch_number and ch_number[:20]
+                        match_values.extend([ch_name, truncated_ch_number, 'Name+Number', 1.0])
+                        batch_matched += 1
                         matched = True
-                
-                # 3. Try Previous name match
-                if not matched:
-                    norm_name = normalize_company_name(prop_name)
-                    
-                    if norm_name and norm_name in ch_previous_names:
-                        ch_name, ch_number = ch_previous_names[norm_name][0]
+                    else:
+                        # Tier 2: Number only match
                         # Truncate company number if too long
-                        truncated_ch_number = ch_number[:20] if ch_number and len(ch_number) > 20 else ch_number
-                        match_values.extend([ch_name, truncated_ch_number, 'Previous_Name', 0.5])
-                        total_matched += 1
+                        truncated_ch_number = ch_number and ch_number[:20]
+                        match_values.extend([ch_name, truncated_ch_number, 'Number', 0.9])
+                        batch_matched += 1
                         matched = True
-                
-                # 4. No match - Use Land Registry data for frontend display
-                if not matched:
-                    # Populate CH fields with Land Registry data for frontend
-                    # Use 'Land_Registry' as match type to indicate source
-                    # Truncate company number if too long for database field
-                    if prop_number and len(prop_number) > 20:
-                        logger.warning(f"Truncating long company number: {prop_number} -> {prop_number[:20]}")
-                        truncated_number = prop_number[:20]
-                    else:
-                        truncated_number = prop_number
-                    match_values.extend([prop_name, truncated_number, 'Land_Registry', 0.3])
-                    total_no_match += 1
             
-            # Add timestamp
-            match_values.append(datetime.now())
+            # 2/3. Try Name only match, then Previous name match (one lookup)
+            if not matched:
+                name_hit = get_by_name(norm_name)
+                
+                if name_hit is not None:
+                    # First company loaded with this name (could be several)
+                    (match_type, confidence), (ch_name, ch_number, _) = name_hit
+                    # Truncate company number if too long
+                    truncated_ch_number = ch_number and ch_number[:20]
+                    match_values.extend([ch_name, truncated_ch_number, match_type, confidence])
+                    batch_matched += 1
+                    matched = True
             
-            batch_data.append(match_values)
+            # 4. No match - Use Land Registry data for frontend display
+            if not matched:
+                # Populate CH fields with Land Registry data for frontend
+                # Use 'Land_Registry' as match type to indicate source
+                # Truncate company number if too long for database field
+                truncated_number = prop_number and prop_number[:20]
+                if truncated_number and len(prop_number) > 20:
+                    logger.warning(f"Truncating long company number: {prop_number} -> {truncated_number}")
+                match_values.extend([prop_name, truncated_number, 'Land_Registry', 0.3])
+                batch_no_match += 1
+        
+        # updated_at is filled by the column's DEFAULT CURRENT_TIMESTAMP
+        batch_data.append(match_values)
+    
+    copy_text = ''.join('\t'.join(map(copy_text_value, row)) + '\n' for row in batch_data)
+    return copy_text, batch_matched, batch_no_match, len(records)
+
+# Keep the CH indexes out of the GC's reach so forked workers don't touch
+# (and copy) their pages just by tracking them
+gc.freeze()
+
+# Process in chunks using keyset pagination on id (no OFFSET rescans)
+last_id = 0
+pending = deque()
+lr_exhausted = False
+
+with multiprocessing.get_context('fork').Pool(num_workers) as pool, \
+        tqdm(total=to_process, desc="Matching") as pbar:
+    while True:
+        # Keep the workers fed without reading the whole table ahead
+        while not lr_exhausted and len(pending) < max_pending:
+            records = fetch_lr_batch(last_id)
+            if not records:
+                lr_exhausted = True
+                break
+            last_id = records[-1][0]
+            pending.append(pool.apply_async(match_batch, (records,)))
+        
+        if not pending:
+            break
         
-        # Insert this batch
-        execute_values(cursor, insert_query, batch_data)
-        conn.commit()  # CRITICAL: Commit after each batch to ensure data is saved
+        # Collect results in fetch order
+        copy_text, batch_matched, batch_no_match, record_count = pending.popleft().get()
+        total_matched += batch_matched
+        total_no_match += batch_no_match
         
-        pbar.update(len(records))
-        offset += batch_size
+        # Stream this batch in with COPY
+        cursor.copy_expert(copy_query, io.StringIO(copy_text))
+        batches_since_commit += 1
+        if batches_since_commit >= commit_every:
+            conn.commit()  # CRITICAL: Commit regularly to ensure data is saved
+            batches_since_commit = 0
+        
+        pbar.update(record_count)
+
+# Commit the final partial group of batches
+conn.commit()
 
 print(f"\n✅ MATCHING COMPLETE!")
 print(f"Total proprietors matched: {total_matched:,}")
@@ -360,55 +461,25 @@ company_categories = (
     'Limited Liability Partnership'
 )
 
-# Get all unique Land_Registry companies (not found in CH data)
+# Get all unique Land_Registry companies (not found in CH data), unpivoting
+# the 4 proprietor slots so both tables are scanned only once
 cursor.execute("""
-    WITH land_registry_companies AS (
-        -- Proprietor 1
-        SELECT DISTINCT 
-            lr.proprietor_1_name as company_name
-        FROM land_registry_data lr
-        JOIN land_registry_ch_matches m ON lr.id = m.id
-        WHERE m.ch_match_type_1 = 'Land_Registry'
-        AND lr.proprietor_1_name IS NOT NULL
-        AND lr.proprietorship_1_category IN %s
-        
-        UNION
-        
-        -- Proprietor 2
-        SELECT DISTINCT 
-            lr.proprietor_2_name as company_name
-        FROM land_registry_data lr
-        JOIN land_registry_ch_matches m ON lr.id = m.id
-        WHERE m.ch_match_type_2 = 'Land_Registry'
-        AND lr.proprietor_2_name IS NOT NULL
-        AND lr.proprietorship_2_category IN %s
-        
-        UNION
-        
-        -- Proprietor 3
-        SELECT DISTINCT 
-            lr.proprietor_3_name as company_name
-        FROM land_registry_data lr
-        JOIN land_registry_ch_matches m ON lr.id = m.id
-        WHERE m.ch_match_type_3 = 'Land_Registry'
-        AND lr.proprietor_3_name IS NOT NULL
-        AND lr.proprietorship_3_category IN %s
-        
-        UNION
-        
-        -- Proprietor 4
-        SELECT DISTINCT 
-            lr.proprietor_4_name as company_name
-        FROM land_registry_data lr
-        JOIN land_registry_ch_matches m ON lr.id = m.id
-        WHERE m.ch_match_type_4 = 'Land_Registry'
-        AND lr.proprietor_4_name IS NOT NULL
-        AND lr.proprietorship_4_category IN %s
-    )
-    SELECT company_name 
-    FROM land_registry_companies
-    ORDER BY company_name
-""", (company_categories, company_categories, company_categories, company_categories))
+    SELECT DISTINCT p.company_name
+    FROM land_registry_data lr
+    JOIN land_registry_ch_matches m ON lr.id = m.id
+    CROSS JOIN LATERAL (VALUES
+        (lr.proprietor_1_name, lr.proprietorship_1_category, m.ch_match_type_1),
+        (lr.proprietor_2_name, lr.proprietorship_2_category, m.ch_match_type_2),
+        (lr.proprietor_3_name, lr.proprietorship_3_category, m.ch_match_type_3),
+        (lr.proprietor_4_name, lr.proprietorship_4_category, m.ch_match_type_4)
+    ) AS p(company_name, category, match_type)
+    WHERE 'Land_Registry' IN (m.ch_match_type_1, m.ch_match_type_2,
+                              m.ch_match_type_3, m.ch_match_type_4)
+    AND p.match_type = 'Land_Registry'
+    AND p.company_name IS NOT NULL
+    AND p.category IN %s
+    ORDER BY p.company_name
+""", (company_categories,))
 
 no_match_companies = cursor.fetchall()
 
@@ -8,16 +8,18 @@ Handles JSON Lines format with various PSC types (individual, corporate-entity,
 """
 
 import os
+import io
 import sys
-import json
+import orjson
 import psycopg2
-from psycopg2.extras import execute_values, Json
 import logging
-from datetime import datetime
+from datetime import date, datetime
 from pathlib import Path
 import argparse
 from tqdm import tqdm
-import gc
+import multiprocessing
+from collections import Counter, deque
+from contextlib import contextmanager
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -35,9 +37,204 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Columns stored as JSONB; everything else is text, a date or the TEXT[] natures
+JSONB_COLUMNS = {'name_elements', 'date_of_birth', 'address', 'identification', 'links'}
+
+# Columns written to psc_stage, in COPY order (process_psc_record's tuple order);
+# source_filename is constant per file and only added by the merge
+PSC_COLUMNS = (
+    'company_number', 'psc_type', 'name', 'name_elements', 'date_of_birth',
+    'country_of_residence', 'nationality', 'address', 'identification',
+    'natures_of_control', 'notified_on', 'ceased_on', 'etag', 'links'
+)
+
+# psc_data is hash partitioned on company_number into this many partitions
+PSC_PARTITIONS = 16
+
+# Cap on the raw bytes in one parse chunk, so a run of huge records can't
+# blow up worker and COPY buffer memory
+MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+def copy_text_escape(value):
+    """Escape a string for COPY ... WITH (FORMAT text)"""
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+def copy_text_value(value):
+    """Render a scalar value for COPY ... WITH (FORMAT text)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return copy_text_escape(value)
+    return str(value)
+
+def copy_jsonb_value(value):
+    """Render a JSON-compatible value for a JSONB column in COPY text format"""
+    if value is None:
+        return '\\N'
+    # orjson escapes control characters itself, so only backslashes need doubling
+    return orjson.dumps(value).decode().replace('\\', '\\\\')
+
+def copy_array_value(values):
+    """Render a list of strings as a TEXT[] literal in COPY text format"""
+    if values is None:
+        return '\\N'
+    elements = ','.join('"' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for v in values)
+    return copy_text_escape('{' + elements + '}')
+
+@contextmanager
+def autocommit(conn):
+    """Run statements that cannot be in a transaction block (e.g. VACUUM)"""
+    previous = conn.autocommit
+    conn.autocommit = True
+    try:
+        yield conn
+    finally:
+        conn.autocommit = previous
+
+COLUMN_ENCODERS = [
+    copy_jsonb_value if col in JSONB_COLUMNS
+    else copy_array_value if col == 'natures_of_control'
+    else copy_text_value
+    for col in PSC_COLUMNS
+]
+
+class _KindBuckets(dict):
+    """Maps a PSC kind to its stats key, classified by substring once per
+    distinct kind (PSC and beneficial-owner variants share a bucket)"""
+    def __missing__(self, psc_type):
+        if 'individual' in psc_type:
+            bucket = 'individual_psc'
+        elif 'corporate-entity' in psc_type:
+            bucket = 'corporate_psc'
+        elif 'legal-person' in psc_type:
+            bucket = 'legal_person_psc'
+        else:
+            bucket = 'other_psc'
+        self[psc_type] = bucket
+        return bucket
+
+KIND_BUCKETS = _KindBuckets()
+
+def parse_date(date_str):
+    """Parse date from various formats"""
+    if not date_str:
+        return None
+    try:
+        # Handle timezone-aware dates (remove Z suffix)
+        if date_str.endswith('Z'):
+            date_str = date_str[:-1]
+        
+        # Try different date formats
+        for fmt in ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S']:
+            try:
+                return datetime.strptime(date_str, fmt).date()
+            except:
+                continue
+                
+        logger.warning(f"Could not parse date: {date_str}")
+        return None
+    except Exception as e:
+        logger.warning(f"Date parsing error: {e} - Date: {date_str}")
+        return None
+        
+def iso_date(date_str):
+    """Return the YYYY-MM-DD prefix of an ISO date for Postgres to cast during COPY.
+    
+    Anything not a valid ISO date goes through parse_date instead.
+    """
+    if (date_str and len(date_str) >= 10 and date_str[4] == '-' and date_str[7] == '-'
+            and (len(date_str) == 10 or date_str[10] == 'T')
+            and date_str[:4].isdigit() and date_str[5:7].isdigit() and date_str[8:10].isdigit()):
+        # The right shape isn't enough: a 2023-02-30 would fail the COPY cast
+        # and lose its whole batch
+        try:
+            date.fromisoformat(date_str[:10])
+            return date_str[:10]
+        except ValueError:
+            pass
+    return parse_date(date_str)
+    
+def process_psc_record(line):
+    """Process a single PSC record from JSON"""
+    try:
+        # Parse JSON line (orjson takes the raw bytes, whitespace included)
+        record = orjson.loads(line)
+        
+        # Extract company number and data
+        company_number = record.get('company_number')
+        data = record.get('data', {})
+        
+        if not company_number or not data:
+            return None
+            
+        # Bind the lookup once; it runs fourteen times per record
+        get = data.get
+        
+        # Determine PSC type
+        psc_type = get('kind', 'unknown')
+        
+        # Parse the record based on type, in PSC_COLUMNS order
+        parsed_record = (
+            company_number,
+            psc_type,
+            get('name'),
+            get('name_elements') or None,
+            get('date_of_birth') or None,
+            get('country_of_residence'),
+            get('nationality'),
+            get('address') or None,
+            get('identification') or None,
+            get('natures_of_control', ()),
+            iso_date(get('notified_on')),
+            iso_date(get('ceased_on')),
+            get('etag'),
+            get('links') or None
+        )
+        
+        return parsed_record
+        
+    except orjson.JSONDecodeError as e:
+        logger.error(f"JSON decode error: {e} - Line: {line[:100]}...")
+        return None
+    except Exception as e:
+        logger.error(f"Error processing record: {e} - Line: {line[:100]}...")
+        return None
+
+def parse_chunk(lines):
+    """Parse a chunk of raw lines into COPY text (runs in a worker process).
+    
+    Returns the COPY text, the per-type counts, the row count and the number
+    of non-blank lines.
+    """
+    counts = Counter()
+    rows = []
+    line_count = 0
+    
+    for line in lines:
+        if not line.strip():
+            continue
+        line_count += 1
+        
+        record = process_psc_record(line)
+        if not record:
+            continue
+            
+        # Count by type
+        counts[KIND_BUCKETS[record[1]]] += 1
+            
+        rows.append('\t'.join([encode(value) for value, encode in zip(record, COLUMN_ENCODERS)]))
+        
+    copy_text = ''.join(row + '\n' for row in rows)
+    return copy_text, counts, len(rows), line_count
+
 class PSCImporter:
-    def __init__(self, batch_size=5000):
+    def __init__(self, batch_size=20000):
         self.batch_size = batch_size
+        # Parse in forked workers; the main process only reads and COPYs
+        self.num_workers = max(1, (os.cpu_count() or 2) - 1)
+        self._copy_query = f"COPY psc_stage ({', '.join(PSC_COLUMNS)}) FROM STDIN WITH (FORMAT text)"
+        self._merge_query = self.build_merge_query(PSC_COLUMNS)
         self.conn = None
         self.cursor = None
         self.stats = {
@@ -79,7 +276,7 @@ class PSCImporter:
         # Create the table
         self.cursor.execute("""
             CREATE TABLE psc_data (
-                id BIGSERIAL PRIMARY KEY,
+                id BIGSERIAL,
                 company_number VARCHAR(20) NOT NULL,
                 psc_type VARCHAR(100) NOT NULL,
                 name TEXT,
@@ -98,26 +295,46 @@ class PSCImporter:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 
+                -- Unique constraints must include the partition key
+                PRIMARY KEY (id, company_number),
+                
                 -- Unique constraint on company_number + etag to handle updates
                 CONSTRAINT uk_company_psc UNIQUE (company_number, etag)
-            );
+            ) PARTITION BY HASH (company_number);
         """)
         
+        # Each partition gets its own smaller unique index, indexes and vacuum
+        for remainder in range(PSC_PARTITIONS):
+            self.cursor.execute(f"""
+                CREATE TABLE psc_data_p{remainder} PARTITION OF psc_data
+                FOR VALUES WITH (MODULUS {PSC_PARTITIONS}, REMAINDER {remainder})
+            """)
+            
+        # Secondary indexes are built by create_indexes() once the data is loaded
+        self.conn.commit()
+        logger.info(f"Created psc_data table with {PSC_PARTITIONS} hash partitions (indexes are built after the load)")
+        
+    def create_indexes(self):
+        """Build the secondary indexes in one pass over the loaded table"""
+        logger.info("Creating psc_data indexes...")
+        self.cursor.execute("SET maintenance_work_mem = '2GB'")
+        self.cursor.execute("SET max_parallel_maintenance_workers = 4")
+        
         # Create indexes for performance
         indexes = [
-            "CREATE INDEX idx_psc_company_number ON psc_data(company_number);",
-            "CREATE INDEX idx_psc_type ON psc_data(psc_type);",
-            "CREATE INDEX idx_psc_name ON psc_data(name);",
-            "CREATE INDEX idx_psc_ceased ON psc_data(ceased_on) WHERE ceased_on IS NULL;",
-            "CREATE INDEX idx_psc_notified ON psc_data(notified_on);",
-            "CREATE INDEX idx_psc_natures ON psc_data USING GIN (natures_of_control);"
+            "CREATE INDEX IF NOT EXISTS idx_psc_company_number ON psc_data(company_number);",
+            "CREATE INDEX IF NOT EXISTS idx_psc_type ON psc_data(psc_type);",
+            "CREATE INDEX IF NOT EXISTS idx_psc_name ON psc_data(name);",
+            "CREATE INDEX IF NOT EXISTS idx_psc_ceased ON psc_data(ceased_on) WHERE ceased_on IS NULL;",
+            "CREATE INDEX IF NOT EXISTS idx_psc_notified ON psc_data(notified_on);",
+            "CREATE INDEX IF NOT EXISTS idx_psc_natures ON psc_data USING GIN (natures_of_control);"
         ]
         
         for idx_sql in indexes:
             self.cursor.execute(idx_sql)
             
         self.conn.commit()
-        logger.info("Created psc_data table with indexes")
+        logger.info("Created psc_data indexes")
         
     def ensure_table_exists(self):
         """Ensure the psc_data table exists"""
@@ -133,158 +350,118 @@ class PSCImporter:
             logger.error("Table psc_data does not exist. Run with --create-table flag first.")
             raise Exception("Table psc_data does not exist")
             
-    def parse_date(self, date_str):
-        """Parse date from various formats"""
-        if not date_str:
-            return None
-        try:
-            # Handle timezone-aware dates (remove Z suffix)
-            if date_str.endswith('Z'):
-                date_str = date_str[:-1]
-            
-            # Try different date formats
-            for fmt in ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S']:
-                try:
-                    return datetime.strptime(date_str, fmt).date()
-                except:
-                    continue
-                    
-            logger.warning(f"Could not parse date: {date_str}")
-            return None
-        except Exception as e:
-            logger.warning(f"Date parsing error: {e} - Date: {date_str}")
-            return None
-            
-    def process_psc_record(self, line, filename):
-        """Process a single PSC record from JSON"""
-        try:
-            # Parse JSON line
-            record = json.loads(line.strip())
-            
-            # Extract company number and data
-            company_number = record.get('company_number')
-            data = record.get('data', {})
-            
-            if not company_number or not data:
-                return None
-                
-            # Determine PSC type
-            psc_type = data.get('kind', 'unknown')
-            
-            # Count by type
-            if 'individual' in psc_type:
-                self.stats['individual_psc'] += 1
-            elif 'corporate-entity' in psc_type:
-                self.stats['corporate_psc'] += 1
-            elif 'legal-person' in psc_type:
-                self.stats['legal_person_psc'] += 1
-            else:
-                self.stats['other_psc'] += 1
-            
-            # Parse the record based on type
-            parsed_record = {
-                'company_number': company_number,
-                'psc_type': psc_type,
-                'name': data.get('name'),
-                'name_elements': Json(data.get('name_elements')) if data.get('name_elements') else None,
-                'date_of_birth': Json(data.get('date_of_birth')) if data.get('date_of_birth') else None,
-                'country_of_residence': data.get('country_of_residence'),
-                'nationality': data.get('nationality'),
-                'address': Json(data.get('address')) if data.get('address') else None,
-                'identification': Json(data.get('identification')) if data.get('identification') else None,
-                'natures_of_control': data.get('natures_of_control', []),
-                'notified_on': self.parse_date(data.get('notified_on')),
-                'ceased_on': self.parse_date(data.get('ceased_on')),
-                'etag': data.get('etag'),
-                'links': Json(data.get('links')) if data.get('links') else None,
-                'source_filename': filename
-            }
-            
-            return parsed_record
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {e} - Line: {line[:100]}...")
-            return None
-        except Exception as e:
-            logger.error(f"Error processing record: {e} - Line: {line[:100]}...")
-            return None
-            
-    def insert_batch(self, batch_data):
-        """Insert a batch of records using ON CONFLICT UPDATE"""
-        if not batch_data:
+    def create_staging_table(self):
+        """Create an empty UNLOGGED psc_stage table with psc_data's column types"""
+        self.cursor.execute("DROP TABLE IF EXISTS psc_stage")
+        self.cursor.execute(f"""
+            CREATE UNLOGGED TABLE psc_stage AS
+            SELECT {', '.join(PSC_COLUMNS)}
+            FROM psc_data
+            WITH NO DATA
+        """)
+        self.conn.commit()
+        
+    def insert_batch(self, copy_text, row_count):
+        """COPY a batch of parsed rows into psc_stage (merged once per file)"""
+        if not row_count:
             return
             
+        # A savepoint per batch keeps one bad batch from discarding the file
+        self.cursor.execute("SAVEPOINT psc_batch")
         try:
-            columns = list(batch_data[0].keys())
+            self.cursor.copy_expert(self._copy_query, io.StringIO(copy_text))
+            self.cursor.execute("RELEASE SAVEPOINT psc_batch")
             
-            # Build INSERT ... ON CONFLICT UPDATE query
-            insert_query = f"""
-                INSERT INTO psc_data ({', '.join(columns)})
-                VALUES %s
-                ON CONFLICT (company_number, etag) DO UPDATE SET
-                    {', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col not in ['company_number', 'etag']])},
-                    updated_at = CURRENT_TIMESTAMP
-            """
-            
-            # Prepare values
-            values = []
-            for record in batch_data:
-                values.append(tuple(record[col] for col in columns))
-                
-            execute_values(self.cursor, insert_query, values)
-            self.conn.commit()
-            
-            self.stats['inserted'] += len(batch_data)
+            self.stats['inserted'] += row_count
             
         except Exception as e:
             logger.error(f"Error inserting batch: {e}")
-            self.conn.rollback()
-            self.stats['errors'] += len(batch_data)
-            # Log first record for debugging
-            if batch_data:
-                logger.error(f"First record in failed batch: {batch_data[0]}")
+            self.cursor.execute("ROLLBACK TO SAVEPOINT psc_batch")
+            self.stats['errors'] += row_count
+            # Log first row for debugging
+            logger.error(f"First row in failed batch: {copy_text.partition(chr(10))[0]}")
+                
+    @staticmethod
+    def build_merge_query(columns):
+        """Build the psc_stage -> psc_data merge statement (takes source_filename)"""
+        column_list = ', '.join(columns)
+        
+        # Keep the last staged row per (company_number, etag) so a key is only
+        # updated once; NULL etags never conflict and are all kept
+        return f"""
+            INSERT INTO psc_data ({column_list}, source_filename)
+            SELECT {column_list}, %(source_filename)s::text FROM (
+                SELECT DISTINCT ON (company_number, etag) {column_list}
+                FROM psc_stage
+                WHERE etag IS NOT NULL
+                ORDER BY company_number, etag, ctid DESC
+            ) latest
+            UNION ALL
+            SELECT {column_list}, %(source_filename)s::text FROM psc_stage WHERE etag IS NULL
+            ON CONFLICT (company_number, etag) DO UPDATE SET
+                {', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col not in ['company_number', 'etag']])},
+                source_filename = EXCLUDED.source_filename,
+                updated_at = CURRENT_TIMESTAMP
+        """
+        
+    def merge_staging_table(self, filename):
+        """Merge psc_stage into psc_data using ON CONFLICT UPDATE, then commit"""
+        self.cursor.execute(self._merge_query, {'source_filename': filename})
+        self.cursor.execute("DROP TABLE psc_stage")
+        self.conn.commit()
             
+    def read_chunk(self, f):
+        """Read up to batch_size lines, stopping early at MAX_CHUNK_BYTES"""
+        lines = []
+        chunk_bytes = 0
+        for line in f:
+            lines.append(line)
+            chunk_bytes += len(line)
+            if len(lines) >= self.batch_size or chunk_bytes >= MAX_CHUNK_BYTES:
+                break
+        return lines, chunk_bytes
+        
     def import_file(self, filepath):
         """Import a PSC data file"""
         filename = os.path.basename(filepath)
         logger.info(f"Starting import of {filename}")
         
-        # Count lines for progress bar
-        logger.info("Counting lines in file...")
-        total_lines = sum(1 for _ in open(filepath, 'r', encoding='utf-8'))
-        logger.info(f"Total lines to process: {total_lines:,}")
+        # Size the progress bar in bytes rather than re-reading the file to count lines
+        file_size = os.path.getsize(filepath)
+        logger.info(f"File size: {file_size / 1024**3:.2f} GB")
         
-        batch_data = []
+        self.create_staging_table()
+        max_pending = self.num_workers * 2  # chunks in flight, caps memory
+        pending = deque()
+        file_exhausted = False
         
-        with open(filepath, 'r', encoding='utf-8') as f:
-            with tqdm(total=total_lines, desc=f"Importing {filename}") as pbar:
-                for line in f:
-                    if not line.strip():
-                        pbar.update(1)
-                        continue
-                        
-                    # Process the record
-                    record = self.process_psc_record(line, filename)
+        with open(filepath, 'rb', buffering=1 << 20) as f, \
+                multiprocessing.get_context('fork').Pool(self.num_workers) as pool, \
+                tqdm(total=file_size, unit='B', unit_scale=True, desc=f"Importing {filename}") as pbar:
+            while True:
+                # Keep the workers fed without reading the whole file ahead
+                while not file_exhausted and len(pending) < max_pending:
+                    lines, chunk_bytes = self.read_chunk(f)
+                    if not lines:
+                        file_exhausted = True
+                        break
+                    pending.append((pool.apply_async(parse_chunk, (lines,)), chunk_bytes))
                     
-                    if record:
-                        batch_data.append(record)
-                        
-                    # Process batch
-                    if len(batch_data) >= self.batch_size:
-                        self.insert_batch(batch_data)
-                        batch_data = []
-                        
-                    pbar.update(1)
-                    self.stats['total_records'] += 1
+                if not pending:
+                    break
                     
-                    # Periodic garbage collection
-                    if self.stats['total_records'] % 100000 == 0:
-                        gc.collect()
-                        
-                # Insert remaining records
-                if batch_data:
-                    self.insert_batch(batch_data)
+                # Collect chunks in file order so the last staged row per key wins
+                result, chunk_bytes = pending.popleft()
+                copy_text, counts, row_count, line_count = result.get()
+                for key, count in counts.items():
+                    self.stats[key] += count
+                self.stats['total_records'] += line_count
+                
+                self.insert_batch(copy_text, row_count)
+                pbar.update(chunk_bytes)
                     
+        logger.info(f"Merging staged records from {filename} into psc_data...")
+        self.merge_staging_table(filename)
         self.stats['files_processed'] += 1
         logger.info(f"Completed importing {filename}")
         
@@ -319,11 +496,14 @@ class PSCImporter:
             for filepath in files_to_import:
                 self.import_file(filepath)
                 
+            # A freshly created table is loaded without indexes; build them now
+            if create_table:
+                self.create_indexes()
+                
             # Run VACUUM ANALYZE (needs autocommit mode)
             logger.info("Running VACUUM ANALYZE on psc_data...")
-            self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-            self.cursor.execute("VACUUM ANALYZE psc_data")
-            self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+            with autocommit(self.conn):
+                self.cursor.execute("VACUUM ANALYZE psc_data")
             
             # Final statistics
             elapsed = (datetime.now() - start_time).total_seconds()
@@ -379,8 +559,8 @@ def main():
     parser.add_argument('--psc-dir', type=str,
                        default='/home/adc/Projects/InsideEstates_App/DATA/SOURCE/CH/PSC',
                        help='Directory containing PSC files')
-    parser.add_argument('--batch-size', type=int, default=5000,
-                       help='Batch size for inserts (default: 5000)')
+    parser.add_argument('--batch-size', type=int, default=20000,
+                       help='Lines per parse/COPY batch (default: 20000)')
     parser.add_argument('--create-table', action='store_true',
                        help='Create the psc_data table (drops existing table)')
     
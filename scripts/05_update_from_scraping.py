@@ -16,15 +16,21 @@ Key Features:
 Created: 2025-09-19
 """
 
+import io
+import os
+import multiprocessing
 import psycopg2
-from psycopg2.extras import execute_values
 import csv
 import sys
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime
 from tqdm import tqdm
 import logging
 import re
+import string
+from collections import deque
+from contextlib import contextmanager
+from operator import itemgetter
 
 # Configure logging
 logging.basicConfig(
@@ -41,6 +47,26 @@ logger = logging.getLogger(__name__)
 sys.path.append(str(Path(__file__).parent.parent))
 from config.postgresql_config import POSTGRESQL_CONFIG
 
+class _KeepTable(dict):
+    """str.translate table that keeps characters passing `keep` and drops the
+    rest, filled in lazily per code point instead of covering all of Unicode"""
+    def __init__(self, keep):
+        super().__init__()
+        self.keep = keep
+    
+    def __missing__(self, codepoint):
+        value = codepoint if self.keep(chr(codepoint)) else None
+        self[codepoint] = value
+        return value
+
+_KEEP_ALNUM = _KeepTable(str.isalnum)
+_KEEP_ASCII_ALNUM = _KeepTable(frozenset(string.ascii_uppercase + string.digits).__contains__)
+
+# Patterns compiled once at import rather than looked up per call
+_SUFFIX_RE = re.compile(r'\s*(LIMITED LIABILITY PARTNERSHIP|LIMITED|COMPANY|LTD\.|LLP|LTD|PLC|CO\.|CO).*$')
+_SIC_RE = re.compile(r'\b(\d{5})\b')
+_DISSOLVED_RE = re.compile(r'dissolved|removed', re.IGNORECASE)
+
 def normalize_company_name(name):
     """PROVEN normalization that REMOVES suffixes - must match 03_match script"""
     if not name or name.strip() == '':
@@ -50,13 +76,10 @@ def normalize_company_name(name):
     name = name.replace(' AND ', ' ').replace(' & ', ' ')
     
     # CRITICAL FIX: Remove suffixes AND anything after them
-    suffix_pattern = r'\s*(LIMITED LIABILITY PARTNERSHIP|LIMITED|COMPANY|LTD\.|LLP|LTD|PLC|CO\.|CO).*$'
-    name = re.sub(suffix_pattern, '', name)
+    name = _SUFFIX_RE.sub('', name)
     
     # Keep only alphanumeric
-    name = ''.join(char for char in name if char.isalnum())
-    
-    return name
+    return name.translate(_KEEP_ALNUM)
 
 def normalize_company_number(number):
     """Normalize company registration numbers"""
@@ -64,7 +87,9 @@ def normalize_company_number(number):
         return ''
     
     number = str(number).strip().upper()
-    number = re.sub(r'[^A-Z0-9]', '', number)
+    if not (number.isascii() and number.isalnum()):
+        # Keep only A-Z0-9 (clean numbers skip this)
+        number = number.translate(_KEEP_ASCII_ALNUM)
     
     # Handle Scottish numbers
     if number.startswith('SC'):
@@ -76,6 +101,15 @@ def normalize_company_number(number):
     
     return number
 
+# Date shapes the scraper produces, each with the strptime formats it can be
+_DATE_FORMATS = (
+    (re.compile(r'\d{1,2}\s+[A-Za-z]+\s+\d{4}'), ('%d %B %Y', '%d %b %Y')),  # 1 January 2020 / 1 Jan 2020
+    (re.compile(r'\d{1,2}/\d{1,2}/\d{4}'), ('%d/%m/%Y',)),                  # 01/01/2020
+    (re.compile(r'\d{4}-\d{1,2}-\d{1,2}'), ('%Y-%m-%d',)),                  # 2020-01-01
+    (re.compile(r'\d{1,2}-\d{1,2}-\d{4}'), ('%d-%m-%Y',)),                  # 01-01-2020
+)
+_ISO_DATE_RE = re.compile(r'\d{4}-\d\d-\d\d')
+
 def parse_date(date_str):
     """Parse various date formats from scraped data"""
     if not date_str or date_str.strip() == '':
@@ -83,20 +117,21 @@ def parse_date(date_str):
     
     date_str = date_str.strip()
     
-    # Try common formats
-    formats = [
-        '%d %B %Y',      # 1 January 2020
-        '%d %b %Y',      # 1 Jan 2020
-        '%d/%m/%Y',      # 01/01/2020
-        '%Y-%m-%d',      # 2020-01-01
-        '%d-%m-%Y',      # 01-01-2020
-    ]
-    
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt).date()
-        except:
-            continue
+    # Pick the format from the string's shape instead of trying each in turn
+    try:
+        if _ISO_DATE_RE.fullmatch(date_str):
+            return date.fromisoformat(date_str)
+        
+        for pattern, formats in _DATE_FORMATS:
+            if pattern.fullmatch(date_str):
+                for fmt in formats:
+                    try:
+                        return datetime.strptime(date_str, fmt).date()
+                    except ValueError:
+                        continue
+                break
+    except ValueError:
+        pass
     
     logger.warning(f"Could not parse date: {date_str}")
     return None
@@ -110,153 +145,338 @@ def parse_sic_codes(sic_str):
     sic_str = sic_str.strip()
     
     # Extract just the numeric codes
-    codes = []
     # Match patterns like "12345 - Description" or just "12345"
-    for match in re.findall(r'\b(\d{5})\b', sic_str):
-        codes.append(match)
+    codes = _SIC_RE.findall(sic_str)
     
     return codes[:4]  # Max 4 SIC codes
 
-def update_companies_table(cursor, scraped_data):
-    """Update the companies table with scraped data"""
+# CSV rows per parse chunk, and so per COPY into the scraped_raw staging table
+BATCH_SIZE = 10000
+
+# scraped_raw columns, in company_update_values order
+SCRAPED_COLUMNS = (
+    'company_number', 'company_name', 'company_status', 'company_type',
+    'registered_office_address', 'incorporation_date', 'is_dissolved',
+    'sic_code_1', 'sic_code_2', 'sic_code_3', 'sic_code_4'
+)
+
+def copy_text_value(value):
+    """Render a scalar value for COPY ... WITH (FORMAT text)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                     .replace('\n', '\\n').replace('\r', '\\r'))
+    return str(value)
+
+# CSV fields parse_rows reads (canonical headers): the status, then the
+# company_update_values arguments in order
+INPUT_COLUMNS = (
+    'status', 'company_number', 'found_name', 'company_type', 'incorporated_on',
+    'company_status', 'registered_office_address', 'sic_codes'
+)
+
+def company_update_values(company_number, found_name, company_type, incorporated_on,
+                          company_status, registered_office_address, sic_codes):
+    """Build the scraped_raw row (SCRAPED_COLUMNS order) for one scraped company"""
+    # Parse SIC codes
+    sic_codes = parse_sic_codes(sic_codes)
+    sic_code_1 = sic_codes[0] if len(sic_codes) > 0 else None
+    sic_code_2 = sic_codes[1] if len(sic_codes) > 1 else None
+    sic_code_3 = sic_codes[2] if len(sic_codes) > 2 else None
+    sic_code_4 = sic_codes[3] if len(sic_codes) > 3 else None
+    
+    # Parse dates
+    incorporation_date = parse_date(incorporated_on)
+    
+    # Determine if company is dissolved
+    is_dissolved = _DISSOLVED_RE.search(company_status) is not None
+    
+    return (
+        company_number,
+        found_name,
+        company_status,
+        company_type,
+        registered_office_address,
+        incorporation_date,
+        is_dissolved,
+        sic_code_1,
+        sic_code_2,
+        sic_code_3,
+        sic_code_4
+    )
+
+def configure_session(cursor):
+    """Session settings for a bulk load whose failure mode is re-running the script"""
+    # Commits don't wait for the WAL flush: a server crash can lose the last
+    # few commits, never corrupt data
+    cursor.execute("SET synchronous_commit = off")
+    cursor.execute("SET work_mem = '256MB'")
+    cursor.execute("SET maintenance_work_mem = '1GB'")
+    # The set-based UPDATEs are big enough to trigger JIT, whose compile time
+    # outweighs anything it saves on these simple expressions
+    cursor.execute("SET jit = off")
+
+@contextmanager
+def autocommit(conn):
+    """Run statements that cannot be in a transaction block (e.g. CREATE INDEX CONCURRENTLY)"""
+    previous = conn.autocommit
+    conn.autocommit = True
     try:
-        # Parse SIC codes
-        sic_codes = parse_sic_codes(scraped_data.get('sic_codes', ''))
-        sic_code_1 = sic_codes[0] if len(sic_codes) > 0 else None
-        sic_code_2 = sic_codes[1] if len(sic_codes) > 1 else None
-        sic_code_3 = sic_codes[2] if len(sic_codes) > 2 else None
-        sic_code_4 = sic_codes[3] if len(sic_codes) > 3 else None
-        
-        # Parse dates
-        incorporation_date = parse_date(scraped_data.get('incorporated_on', ''))
-        
-        # Determine if company is dissolved
-        company_status = scraped_data.get('company_status', '').lower()
-        is_dissolved = 'dissolved' in company_status or 'removed' in company_status
-        
-        # Update companies table
-        cursor.execute("""
-            UPDATE companies
-            SET 
-                company_name = %(company_name)s,
-                ch_matched = TRUE,
-                scraped_data = TRUE,
-                company_status = %(company_status)s,
-                company_category = %(company_type)s,
-                registered_address_line1 = %(registered_office_address)s,
-                incorporation_date = %(incorporation_date)s,
-                dissolution_date = CASE WHEN %(is_dissolved)s THEN CURRENT_DATE ELSE NULL END,
-                sic_code_1 = %(sic_code_1)s,
-                sic_code_2 = %(sic_code_2)s,
-                sic_code_3 = %(sic_code_3)s,
-                sic_code_4 = %(sic_code_4)s,
-                last_scrape_check = CURRENT_DATE,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE company_number = %(company_number)s
-        """, {
-            'company_number': scraped_data['company_number'],
-            'company_name': scraped_data['found_name'],
-            'company_status': scraped_data.get('company_status', ''),
-            'company_type': scraped_data.get('company_type', ''),
-            'registered_office_address': scraped_data.get('registered_office_address', ''),
-            'incorporation_date': incorporation_date,
-            'is_dissolved': is_dissolved,
-            'sic_code_1': sic_code_1,
-            'sic_code_2': sic_code_2,
-            'sic_code_3': sic_code_3,
-            'sic_code_4': sic_code_4
-        })
-        
-        return cursor.rowcount > 0
-        
-    except Exception as e:
-        logger.error(f"Error updating company {scraped_data.get('company_number', 'UNKNOWN')}: {e}")
-        return False
+        yield conn
+    finally:
+        conn.autocommit = previous
+
+def ensure_match_slot_indexes(conn):
+    """Index each match slot's company number, limited to rows still typed 'Land_Registry'"""
+    # The per-slot UPDATEs only touch 'Land_Registry' rows, and rows leave the
+    # index as they are flipped to 'Scraped', so these stay small
+    with autocommit(conn), conn.cursor() as cursor:
+        for slot in range(1, 5):
+            index_name = f"idx_lrchm_slot{slot}_lr"
+            
+            # An interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index
+            # under the same name, which IF NOT EXISTS would then keep
+            cursor.execute(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+                (index_name,)
+            )
+            row = cursor.fetchone()
+            if row and not row[0]:
+                logger.warning(f"Dropping invalid index {index_name} to rebuild it")
+                cursor.execute(f"DROP INDEX CONCURRENTLY {index_name}")
+            
+            cursor.execute(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name}
+                ON land_registry_ch_matches (ch_matched_number_{slot})
+                WHERE ch_match_type_{slot} = 'Land_Registry'
+            """)
 
-def update_match_table(cursor, company_number, found_name):
-    """Update land_registry_ch_matches to reflect scraped data"""
+# scraped_raw column -> the companies column update_companies_table writes it to
+STAGING_TARGETS = {
+    'company_number': 'company_number',
+    'company_name': 'company_name',
+    'company_status': 'company_status',
+    'company_type': 'company_category',
+    'registered_office_address': 'registered_address_line1',
+    'sic_code_1': 'sic_code_1',
+    'sic_code_2': 'sic_code_2',
+    'sic_code_3': 'sic_code_3',
+    'sic_code_4': 'sic_code_4',
+}
+
+def target_column_types(cursor, table, columns):
+    """Declared type of each column (e.g. 'character varying(100)'), TEXT if the table lacks it"""
+    cursor.execute("""
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass
+          AND attname = ANY(%s)
+          AND attnum > 0
+          AND NOT attisdropped
+    """, (table, list(columns)))
+    types = dict(cursor.fetchall())
+    return {column: types.get(column, 'TEXT') for column in columns}
+
+def create_staging_tables(cursor):
+    """Create the session temp tables the scraped rows are staged in"""
+    # Stage with the target columns' types so an oversized value is rejected
+    # by its batch's COPY rather than aborting the final set-based UPDATE
+    types = target_column_types(cursor, 'companies', set(STAGING_TARGETS.values()))
+    staged = {column: types[target] for column, target in STAGING_TARGETS.items()}
+    
+    # Not ON COMMIT DROP: main() commits after every batch and the tables
+    # have to survive until the set-based updates at the end
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS scraped_raw (
+            seq BIGSERIAL,
+            company_number {staged['company_number']},
+            company_name {staged['company_name']},
+            company_status {staged['company_status']},
+            company_type {staged['company_type']},
+            registered_office_address {staged['registered_office_address']},
+            incorporation_date DATE,
+            is_dissolved BOOLEAN,
+            sic_code_1 {staged['sic_code_1']},
+            sic_code_2 {staged['sic_code_2']},
+            sic_code_3 {staged['sic_code_3']},
+            sic_code_4 {staged['sic_code_4']}
+        )
+    """)
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS scraped_ids (
+            company_number TEXT PRIMARY KEY,
+            found_name TEXT
+        )
+    """)
+
+def stage_scraped_rows(cursor, copy_lines):
+    """COPY a batch of scraped rows (COPY text lines) into scraped_raw; returns (staged, skipped)"""
+    if not copy_lines:
+        return 0, 0
+    
+    # A savepoint keeps one bad batch from aborting the whole transaction
+    cursor.execute("SAVEPOINT scraped_batch")
     try:
-        # Update all matches for this company number from 'Land_Registry' to 'Scraped'
-        cursor.execute("""
-            UPDATE land_registry_ch_matches
-            SET 
-                ch_matched_name_1 = CASE 
-                    WHEN ch_matched_number_1 = %s AND ch_match_type_1 = 'Land_Registry' 
-                    THEN %s 
-                    ELSE ch_matched_name_1 
-                END,
-                ch_match_type_1 = CASE 
-                    WHEN ch_matched_number_1 = %s AND ch_match_type_1 = 'Land_Registry' 
-                    THEN 'Scraped' 
-                    ELSE ch_match_type_1 
-                END,
-                ch_match_confidence_1 = CASE 
-                    WHEN ch_matched_number_1 = %s AND ch_match_type_1 = 'Land_Registry' 
-                    THEN 0.8 
-                    ELSE ch_match_confidence_1 
-                END,
-                
-                ch_matched_name_2 = CASE 
-                    WHEN ch_matched_number_2 = %s AND ch_match_type_2 = 'Land_Registry' 
-                    THEN %s 
-                    ELSE ch_matched_name_2 
-                END,
-                ch_match_type_2 = CASE 
-                    WHEN ch_matched_number_2 = %s AND ch_match_type_2 = 'Land_Registry' 
-                    THEN 'Scraped' 
-                    ELSE ch_match_type_2 
-                END,
-                ch_match_confidence_2 = CASE 
-                    WHEN ch_matched_number_2 = %s AND ch_match_type_2 = 'Land_Registry' 
-                    THEN 0.8 
-                    ELSE ch_match_confidence_2 
-                END,
-                
-                ch_matched_name_3 = CASE 
-                    WHEN ch_matched_number_3 = %s AND ch_match_type_3 = 'Land_Registry' 
-                    THEN %s 
-                    ELSE ch_matched_name_3 
-                END,
-                ch_match_type_3 = CASE 
-                    WHEN ch_matched_number_3 = %s AND ch_match_type_3 = 'Land_Registry' 
-                    THEN 'Scraped' 
-                    ELSE ch_match_type_3 
-                END,
-                ch_match_confidence_3 = CASE 
-                    WHEN ch_matched_number_3 = %s AND ch_match_type_3 = 'Land_Registry' 
-                    THEN 0.8 
-                    ELSE ch_match_confidence_3 
-                END,
-                
-                ch_matched_name_4 = CASE 
-                    WHEN ch_matched_number_4 = %s AND ch_match_type_4 = 'Land_Registry' 
-                    THEN %s 
-                    ELSE ch_matched_name_4 
-                END,
-                ch_match_type_4 = CASE 
-                    WHEN ch_matched_number_4 = %s AND ch_match_type_4 = 'Land_Registry' 
-                    THEN 'Scraped' 
-                    ELSE ch_match_type_4 
-                END,
-                ch_match_confidence_4 = CASE 
-                    WHEN ch_matched_number_4 = %s AND ch_match_type_4 = 'Land_Registry' 
-                    THEN 0.8 
-                    ELSE ch_match_confidence_4 
-                END,
-                
-                updated_at = CURRENT_TIMESTAMP
-            WHERE 
-                (ch_matched_number_1 = %s AND ch_match_type_1 = 'Land_Registry') OR
-                (ch_matched_number_2 = %s AND ch_match_type_2 = 'Land_Registry') OR
-                (ch_matched_number_3 = %s AND ch_match_type_3 = 'Land_Registry') OR
-                (ch_matched_number_4 = %s AND ch_match_type_4 = 'Land_Registry')
-        """, (company_number, found_name) * 4 + (company_number,) * 4)
-        
-        return cursor.rowcount
+        cursor.copy_expert(
+            f"COPY scraped_raw ({', '.join(SCRAPED_COLUMNS)}) FROM STDIN WITH (FORMAT text)",
+            io.StringIO('\n'.join(copy_lines) + '\n')
+        )
+        cursor.execute("RELEASE SAVEPOINT scraped_batch")
+        return len(copy_lines), 0
         
     except Exception as e:
-        logger.error(f"Error updating matches for {company_number}: {e}")
-        return 0
+        cursor.execute("ROLLBACK TO SAVEPOINT scraped_batch")
+        cursor.execute("RELEASE SAVEPOINT scraped_batch")
+        if len(copy_lines) == 1:
+            logger.error(f"Skipping scraped row: {e}")
+            logger.error(f"Skipped row: {copy_lines[0]}")
+            return 0, 1
+    
+    # Split the batch until the rows the column types reject are isolated,
+    # so only they are lost rather than the whole batch
+    middle = len(copy_lines) // 2
+    first_staged, first_skipped = stage_scraped_rows(cursor, copy_lines[:middle])
+    second_staged, second_skipped = stage_scraped_rows(cursor, copy_lines[middle:])
+    return first_staged + second_staged, first_skipped + second_skipped
+
+def update_companies_table(cursor):
+    """Update the companies table from every staged row in one statement"""
+    cursor.execute("ANALYZE scraped_raw")
+    
+    # The last scraped row for a company wins, as it did when updated one by one
+    cursor.execute("""
+        UPDATE companies
+        SET 
+            company_name = v.company_name,
+            ch_matched = TRUE,
+            scraped_data = TRUE,
+            company_status = v.company_status,
+            company_category = v.company_type,
+            registered_address_line1 = v.registered_office_address,
+            incorporation_date = v.incorporation_date,
+            dissolution_date = CASE WHEN v.is_dissolved THEN CURRENT_DATE ELSE NULL END,
+            sic_code_1 = v.sic_code_1,
+            sic_code_2 = v.sic_code_2,
+            sic_code_3 = v.sic_code_3,
+            sic_code_4 = v.sic_code_4,
+            last_scrape_check = CURRENT_DATE,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT DISTINCT ON (company_number) *
+            FROM scraped_raw
+            ORDER BY company_number, seq DESC
+        ) v
+        WHERE companies.company_number = v.company_number
+    """)
+    return cursor.rowcount
+
+def match_slot_update_sql(slot):
+    """UPDATE flipping one match slot's 'Land_Registry' matches to 'Scraped' from scraped_ids"""
+    return f"""
+        UPDATE land_registry_ch_matches m
+        SET 
+            ch_matched_name_{slot} = s.found_name,
+            ch_match_type_{slot} = 'Scraped',
+            ch_match_confidence_{slot} = 0.8,
+            updated_at = CURRENT_TIMESTAMP
+        FROM scraped_ids s
+        WHERE m.ch_matched_number_{slot} = s.company_number
+          AND m.ch_match_type_{slot} = 'Land_Registry'
+    """
+
+def update_match_table(cursor):
+    """Update land_registry_ch_matches to reflect scraped data, one UPDATE per match slot"""
+    matches_updated = 0
+    
+    # First found_name wins, as the per-row UPDATE had already flipped the slot to 'Scraped'
+    cursor.execute("""
+        INSERT INTO scraped_ids (company_number, found_name)
+        SELECT DISTINCT ON (company_number) company_number, company_name
+        FROM scraped_raw
+        ORDER BY company_number, seq
+        ON CONFLICT DO NOTHING
+    """)
+    cursor.execute("ANALYZE scraped_ids")
+    
+    for slot in range(1, 5):
+        # Update matches in this slot from 'Land_Registry' to 'Scraped'
+        cursor.execute(match_slot_update_sql(slot))
+        matches_updated += cursor.rowcount
+    
+    # Refresh planner stats now a batch of slots has changed type
+    cursor.execute("ANALYZE land_registry_ch_matches")
+    
+    return matches_updated
+
+def canonical_header(header):
+    """Map a scraper CSV header ('Company Number' or 'company_number') to one key"""
+    return header.strip().lower().replace(' ', '_')
+
+# Scraper status values as it normally writes them; only other spellings are upper-cased
+_STATUSES = frozenset(('FOUND', 'NOT_FOUND'))
+
+def read_chunks(reader, size):
+    """Yield lists of up to `size` non-blank CSV rows"""
+    chunk = []
+    for cells in reader:
+        if not cells:
+            continue  # skip blank lines
+        chunk.append(cells)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def parse_rows(headers, rows):
+    """Parse a chunk of CSV rows into scraped_raw COPY lines (runs in a worker process).
+    
+    Returns the COPY lines and the found / not found / error counts.
+    """
+    copy_lines = []
+    found_count = 0
+    not_found_count = 0
+    error_count = 0
+    
+    # Pick the INPUT_COLUMNS cells straight out of each row; a column the CSV
+    # lacks reads an empty cell appended to every row
+    width = len(headers)
+    positions = {header: i for i, header in enumerate(headers)}
+    input_cells = itemgetter(*(positions.get(column, width) for column in INPUT_COLUMNS))
+    
+    # Bound once rather than looked up on every row
+    add_line = copy_lines.append
+    join_fields = '\t'.join
+    
+    for cells in rows:
+        if len(cells) != width:
+            cells = (cells + [''] * width)[:width]
+        cells.append('')
+        status, company_number, *fields = input_cells(cells)
+        if status not in _STATUSES:
+            status = status.upper()
+        
+        if status == 'FOUND':
+            found_count += 1
+            
+            if company_number:
+                # Queue the row for the scraped_raw COPY
+                add_line(join_fields(map(copy_text_value, company_update_values(company_number, *fields))))
+                
+        elif status == 'NOT_FOUND':
+            not_found_count += 1
+        else:
+            error_count += 1
+    
+    return copy_lines, found_count, not_found_count, error_count
+
+def count_csv_lines(csv_file):
+    """Count data lines in a CSV for the progress bar, reading it in 1MB blocks"""
+    # Quoted multi-line fields make this an upper bound on the row count
+    with open(csv_file, 'rb') as f:
+        lines = sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b''))
+    return max(lines - 1, 0)
 
 def main():
     """Main function to process scraped data"""
@@ -276,6 +496,12 @@ def main():
     # Connect to database
     conn = psycopg2.connect(**POSTGRESQL_CONFIG)
     cursor = conn.cursor()
+    configure_session(cursor)
+    conn.commit()
+    
+    print("Checking land_registry_ch_matches slot indexes...")
+    ensure_match_slot_indexes(conn)
+    create_staging_tables(cursor)
     
     # Read CSV and process
     print(f"Reading {csv_file}...")
@@ -284,61 +510,56 @@ def main():
     found_count = 0
     not_found_count = 0
     error_count = 0
-    companies_updated = 0
-    matches_updated = 0
+    companies_staged = 0
+    rows_skipped = 0
     
-    with open(csv_file, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
-        total_rows = len(rows)
+    # Stream the rows rather than holding the whole CSV in memory
+    line_count = count_csv_lines(csv_file)
+    print(f"Found {line_count:,} lines in CSV file\n")
     
-    print(f"Found {total_rows:,} rows in CSV file\n")
+    # Parse chunks in forked workers; the main process only reads and COPYs
+    num_workers = max(1, (os.cpu_count() or 2) - 1)
+    max_pending = num_workers * 2  # chunks in flight, caps memory
+    pending = deque()
     
-    with tqdm(total=total_rows, desc="Processing scraped data") as pbar:
-        for row in rows:
-            status = row.get('Status', row.get('status', '')).upper()
+    with open(csv_file, 'r', encoding='utf-8') as f, \
+         multiprocessing.get_context('fork').Pool(num_workers) as pool, \
+         tqdm(total=line_count, desc="Processing scraped data") as pbar:
+        # Normalise the header once; parse_rows maps it to cell positions
+        reader = csv.reader(f)
+        headers = [canonical_header(h) for h in next(reader, [])]
+        chunks = read_chunks(reader, BATCH_SIZE)
+        
+        while True:
+            # Keep the workers fed without reading the whole file ahead
+            for chunk in chunks:
+                pending.append((pool.apply_async(parse_rows, (headers, chunk)), len(chunk)))
+                if len(pending) >= max_pending:
+                    break
             
-            if status == 'FOUND':
-                found_count += 1
-                
-                # Extract company number and name
-                company_number = row.get('Company Number', row.get('company_number', ''))
-                found_name = row.get('Found Name', row.get('found_name', ''))
-                
-                if company_number:
-                    # Prepare scraped data
-                    scraped_data = {
-                        'company_number': company_number,
-                        'found_name': found_name,
-                        'company_type': row.get('Company Type', row.get('company_type', '')),
-                        'incorporated_on': row.get('Incorporated On', row.get('incorporated_on', '')),
-                        'company_status': row.get('Company Status', row.get('company_status', '')),
-                        'registered_office_address': row.get('Registered Office Address', row.get('registered_office_address', '')),
-                        'sic_codes': row.get('SIC Codes', row.get('sic_codes', '')),
-                        'previous_names': row.get('Previous Names', row.get('previous_names', ''))
-                    }
-                    
-                    # Update companies table
-                    if update_companies_table(cursor, scraped_data):
-                        companies_updated += 1
-                    
-                    # Update match table
-                    matches_count = update_match_table(cursor, company_number, found_name)
-                    if matches_count > 0:
-                        matches_updated += matches_count
-                    
-            elif status == 'NOT_FOUND':
-                not_found_count += 1
-            else:
-                error_count += 1
+            if not pending:
+                break
             
-            pbar.update(1)
+            # Collect chunks in file order so scraped_raw.seq follows the CSV
+            result, row_count = pending.popleft()
+            copy_lines, found, not_found, errors = result.get()
+            total_rows += row_count
+            found_count += found
+            not_found_count += not_found
+            error_count += errors
             
-            # Commit every 1000 rows
-            if pbar.n % 1000 == 0:
-                conn.commit()
+            staged, skipped = stage_scraped_rows(cursor, copy_lines)
+            companies_staged += staged
+            rows_skipped += skipped
+            # Commit once per staged batch
+            conn.commit()
+            pbar.update(row_count)
     
-    # Final commit
+    # Update companies and match tables for every scraped company at once, then final commit
+    print(f"Updating companies from {companies_staged:,} staged rows...")
+    companies_updated = update_companies_table(cursor)
+    print("Updating land_registry_ch_matches...")
+    matches_updated = update_match_table(cursor)
     conn.commit()
     
     # Print statistics
@@ -349,6 +570,7 @@ def main():
     print(f"Found companies: {found_count:,}")
     print(f"Not found: {not_found_count:,}")
     print(f"Errors: {error_count:,}")
+    print(f"Rows skipped (rejected when staged): {rows_skipped:,}")
     print(f"\nDatabase Updates:")
     print(f"Companies table updated: {companies_updated:,}")
     print(f"Match records updated: {matches_updated:,}")
@@ -15,15 +15,20 @@ Key Features:
 Created: 2025-09-19
 """
 
+import io
+import os
+import multiprocessing
 import psycopg2
-from psycopg2.extras import execute_values
 import csv
 import sys
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime
 from tqdm import tqdm
 import logging
 import re
+import string
+from collections import deque
+from operator import itemgetter
 
 # Configure logging
 logging.basicConfig(
@@ -40,6 +45,24 @@ logger = logging.getLogger(__name__)
 sys.path.append(str(Path(__file__).parent.parent))
 from config.postgresql_config import POSTGRESQL_CONFIG
 
+class _KeepTable(dict):
+    """str.translate table that keeps characters passing `keep` and drops the
+    rest, filled in lazily per code point instead of covering all of Unicode"""
+    def __init__(self, keep):
+        super().__init__()
+        self.keep = keep
+    
+    def __missing__(self, codepoint):
+        value = codepoint if self.keep(chr(codepoint)) else None
+        self[codepoint] = value
+        return value
+
+_KEEP_ALNUM = _KeepTable(str.isalnum)
+_KEEP_ASCII_ALNUM = _KeepTable(frozenset(string.ascii_uppercase + string.digits).__contains__)
+
+# Patterns compiled once at import rather than looked up per call
+_SUFFIX_RE = re.compile(r'\s*(LIMITED LIABILITY PARTNERSHIP|LIMITED|COMPANY|LTD\.|LLP|LTD|PLC|CO\.|CO).*$')
+
 def normalize_company_name(name):
     """PROVEN normalization that REMOVES suffixes - must match 03_match script"""
     if not name or name.strip() == '':
@@ -49,13 +72,10 @@ def normalize_company_name(name):
     name = name.replace(' AND ', ' ').replace(' & ', ' ')
     
     # CRITICAL FIX: Remove suffixes AND anything after them
-    suffix_pattern = r'\s*(LIMITED LIABILITY PARTNERSHIP|LIMITED|COMPANY|LTD\.|LLP|LTD|PLC|CO\.|CO).*$'
-    name = re.sub(suffix_pattern, '', name)
+    name = _SUFFIX_RE.sub('', name)
     
     # Keep only alphanumeric
-    name = ''.join(char for char in name if char.isalnum())
-    
-    return name
+    return name.translate(_KEEP_ALNUM)
 
 def normalize_company_number(number):
     """Normalize company registration numbers"""
@@ -63,7 +83,9 @@ def normalize_company_number(number):
         return ''
     
     number = str(number).strip().upper()
-    number = re.sub(r'[^A-Z0-9]', '', number)
+    if not (number.isascii() and number.isalnum()):
+        # Keep only A-Z0-9 (clean numbers skip this)
+        number = number.translate(_KEEP_ASCII_ALNUM)
     
     # Handle Scottish numbers
     if number.startswith('SC'):
@@ -75,6 +97,15 @@ def normalize_company_number(number):
     
     return number
 
+# Date shapes the scraper produces, each with the strptime formats it can be
+_DATE_FORMATS = (
+    (re.compile(r'\d{1,2}\s+[A-Za-z]+\s+\d{4}'), ('%d %B %Y', '%d %b %Y')),  # 1 January 2020 / 1 Jan 2020
+    (re.compile(r'\d{1,2}/\d{1,2}/\d{4}'), ('%d/%m/%Y',)),                  # 01/01/2020
+    (re.compile(r'\d{4}-\d{1,2}-\d{1,2}'), ('%Y-%m-%d',)),                  # 2020-01-01
+    (re.compile(r'\d{1,2}-\d{1,2}-\d{4}'), ('%d-%m-%Y',)),                  # 01-01-2020
+)
+_ISO_DATE_RE = re.compile(r'\d{4}-\d\d-\d\d')
+
 def parse_date(date_str):
     """Parse various date formats from scraped data"""
     if not date_str or date_str.strip() == '':
@@ -82,20 +113,21 @@ def parse_date(date_str):
     
     date_str = date_str.strip()
     
-    # Try common formats
-    formats = [
-        '%d %B %Y',      # 1 January 2020
-        '%d %b %Y',      # 1 Jan 2020
-        '%d/%m/%Y',      # 01/01/2020
-        '%Y-%m-%d',      # 2020-01-01
-        '%d-%m-%Y',      # 01-01-2020
-    ]
-    
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt).date()
-        except:
-            continue
+    # Pick the format from the string's shape instead of trying each in turn
+    try:
+        if _ISO_DATE_RE.fullmatch(date_str):
+            return date.fromisoformat(date_str)
+        
+        for pattern, formats in _DATE_FORMATS:
+            if pattern.fullmatch(date_str):
+                for fmt in formats:
+                    try:
+                        return datetime.strptime(date_str, fmt).date()
+                    except ValueError:
+                        continue
+                break
+    except ValueError:
+        pass
     
     logger.warning(f"Could not parse date: {date_str}")
     return None
@@ -130,93 +162,221 @@ def ensure_scraped_columns(cursor):
     
     print("✅ Scraped data columns ready\n")
 
-def update_companies_house_data(cursor, scraped_data):
-    """Update or insert Companies House data with scraped information"""
-    company_number = normalize_company_number(scraped_data.get('company_number', ''))
+# CSV rows per parse chunk, and so per COPY into the scraped_raw staging table
+BATCH_SIZE = 10000
+
+# Column order of the scraped row tuples built by scraped_values (and of scraped_raw)
+SCRAPED_COLUMNS = (
+    'company_number', 'found_name', 'company_type', 'incorporation_date',
+    'company_status', 'registered_office_address', 'sic_codes',
+    'previous_names', 'accounts_due', 'confirmation_due', 'search_name'
+)
+
+def copy_text_value(value):
+    """Render a scalar value for COPY ... WITH (FORMAT text)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                     .replace('\n', '\\n').replace('\r', '\\r'))
+    return str(value)
+
+# CSV fields parse_rows reads (canonical headers): the status, then the
+# scraped_values arguments in order
+INPUT_COLUMNS = (
+    'status', 'company_number', 'found_name', 'company_type', 'incorporated_on',
+    'company_status', 'registered_office_address', 'sic_codes', 'previous_names',
+    'accounts_next_due', 'confirmation_statement_next_due', 'search_name'
+)
+
+def scraped_values(company_number, found_name, company_type, incorporated_on,
+                   company_status, registered_office_address, sic_codes, previous_names,
+                   accounts_next_due, confirmation_statement_next_due, search_name):
+    """Build the companies_house_data row tuple (SCRAPED_COLUMNS order) for one scraped company"""
+    company_number = normalize_company_number(company_number)
     if not company_number:
-        return False
+        return None
     
+    return (
+        company_number,
+        found_name,
+        company_type,
+        parse_date(incorporated_on),
+        company_status,
+        registered_office_address,
+        sic_codes,
+        previous_names,
+        accounts_next_due,
+        confirmation_statement_next_due,
+        search_name
+    )
+
+def configure_session(cursor):
+    """Session settings for a bulk load whose failure mode is re-running the script"""
+    # Commits don't wait for the WAL flush: a server crash can lose the last
+    # few commits, never corrupt data
+    cursor.execute("SET synchronous_commit = off")
+    cursor.execute("SET work_mem = '256MB'")
+    cursor.execute("SET maintenance_work_mem = '1GB'")
+    # The set-based UPDATEs are big enough to trigger JIT, whose compile time
+    # outweighs anything it saves on these simple expressions
+    cursor.execute("SET jit = off")
+
+# scraped_raw column -> the companies_house_data column update_companies_house_data
+# writes it to (company_status also feeds company_status, declared the same)
+STAGING_TARGETS = {
+    'company_number': 'company_number',
+    'found_name': 'company_name',
+    'company_type': 'scraped_company_type',
+    'company_status': 'scraped_company_status',
+    'registered_office_address': 'scraped_registered_address',
+    'sic_codes': 'scraped_sic_codes',
+    'previous_names': 'scraped_previous_names',
+    'accounts_due': 'scraped_accounts_due',
+    'confirmation_due': 'scraped_confirmation_due',
+    'search_name': 'scraped_search_name',
+}
+
+def target_column_types(cursor, table, columns):
+    """Declared type of each column (e.g. 'character varying(100)'), TEXT if the table lacks it"""
+    cursor.execute("""
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass
+          AND attname = ANY(%s)
+          AND attnum > 0
+          AND NOT attisdropped
+    """, (table, list(columns)))
+    types = dict(cursor.fetchall())
+    return {column: types.get(column, 'TEXT') for column in columns}
+
+def create_staging_table(cursor):
+    """Create the session temp table the scraped rows are staged in"""
+    # Stage with the target columns' types so an oversized value is rejected
+    # by its batch's COPY rather than aborting the final upsert
+    types = target_column_types(cursor, 'companies_house_data', set(STAGING_TARGETS.values()))
+    staged = {column: types[target] for column, target in STAGING_TARGETS.items()}
+    
+    # Not ON COMMIT DROP: main() commits after every batch and the table
+    # has to survive until the set-based writes at the end
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS scraped_raw (
+            seq BIGSERIAL,
+            company_number {staged['company_number']},
+            found_name {staged['found_name']},
+            company_type {staged['company_type']},
+            incorporation_date DATE,
+            company_status {staged['company_status']},
+            registered_office_address {staged['registered_office_address']},
+            sic_codes {staged['sic_codes']},
+            previous_names {staged['previous_names']},
+            accounts_due {staged['accounts_due']},
+            confirmation_due {staged['confirmation_due']},
+            search_name {staged['search_name']}
+        )
+    """)
+
+def stage_scraped_rows(cursor, copy_lines):
+    """COPY a batch of scraped rows (COPY text lines) into scraped_raw; returns (staged, skipped)"""
+    if not copy_lines:
+        return 0, 0
+    
+    # A savepoint keeps one bad batch from aborting the whole transaction
+    cursor.execute("SAVEPOINT scraped_batch")
     try:
-        # Check if company exists
-        cursor.execute("""
-            SELECT company_number FROM companies_house_data 
-            WHERE company_number = %s
-        """, (company_number,))
+        cursor.copy_expert(
+            f"COPY scraped_raw ({', '.join(SCRAPED_COLUMNS)}) FROM STDIN WITH (FORMAT text)",
+            io.StringIO('\n'.join(copy_lines) + '\n')
+        )
+        cursor.execute("RELEASE SAVEPOINT scraped_batch")
+        return len(copy_lines), 0
         
-        exists = cursor.fetchone() is not None
-        
-        if exists:
-            # Update existing record
-            cursor.execute("""
-                UPDATE companies_house_data
-                SET 
-                    scraped_data = TRUE,
-                    scraped_company_type = %s,
-                    scraped_incorporation_date = %s,
-                    scraped_company_status = %s,
-                    scraped_registered_address = %s,
-                    scraped_sic_codes = %s,
-                    scraped_previous_names = %s,
-                    scraped_accounts_due = %s,
-                    scraped_confirmation_due = %s,
-                    last_scraped_date = CURRENT_TIMESTAMP,
-                    scraped_search_name = %s
-                WHERE company_number = %s
-            """, (
-                scraped_data.get('company_type', ''),
-                parse_date(scraped_data.get('incorporated_on', '')),
-                scraped_data.get('company_status', ''),
-                scraped_data.get('registered_office_address', ''),
-                scraped_data.get('sic_codes', ''),
-                scraped_data.get('previous_names', ''),
-                scraped_data.get('accounts_next_due', ''),
-                scraped_data.get('confirmation_statement_next_due', ''),
-                scraped_data.get('search_name', ''),
-                company_number
-            ))
-            return 'updated'
-        else:
-            # Insert new record
-            cursor.execute("""
-                INSERT INTO companies_house_data (
-                    company_name,
-                    company_number,
-                    company_status,
-                    incorporation_date,
-                    scraped_data,
-                    scraped_company_type,
-                    scraped_incorporation_date,
-                    scraped_company_status,
-                    scraped_registered_address,
-                    scraped_sic_codes,
-                    scraped_previous_names,
-                    scraped_accounts_due,
-                    scraped_confirmation_due,
-                    last_scraped_date,
-                    scraped_search_name
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                scraped_data.get('found_name', ''),
-                company_number,
-                scraped_data.get('company_status', ''),
-                parse_date(scraped_data.get('incorporated_on', '')),
-                True,
-                scraped_data.get('company_type', ''),
-                parse_date(scraped_data.get('incorporated_on', '')),
-                scraped_data.get('company_status', ''),
-                scraped_data.get('registered_office_address', ''),
-                scraped_data.get('sic_codes', ''),
-                scraped_data.get('previous_names', ''),
-                scraped_data.get('accounts_next_due', ''),
-                scraped_data.get('confirmation_statement_next_due', ''),
-                datetime.now(),
-                scraped_data.get('search_name', '')
-            ))
-            return 'inserted'
-            
     except Exception as e:
-        logger.error(f"Error updating/inserting company {company_number}: {e}")
-        return False
+        cursor.execute("ROLLBACK TO SAVEPOINT scraped_batch")
+        cursor.execute("RELEASE SAVEPOINT scraped_batch")
+        if len(copy_lines) == 1:
+            logger.error(f"Skipping scraped row: {e}")
+            logger.error(f"Skipped row: {copy_lines[0]}")
+            return 0, 1
+    
+    # Split the batch until the rows the column types reject are isolated,
+    # so only they are lost rather than the whole batch
+    middle = len(copy_lines) // 2
+    first_staged, first_skipped = stage_scraped_rows(cursor, copy_lines[:middle])
+    second_staged, second_skipped = stage_scraped_rows(cursor, copy_lines[middle:])
+    return first_staged + second_staged, first_skipped + second_skipped
+
+def update_companies_house_data(cursor):
+    """Upsert Companies House data from every staged scraped row
+    
+    Returns (updated, inserted) counts.
+    """
+    cursor.execute("ANALYZE scraped_raw")
+    
+    # One INSERT ... ON CONFLICT on the company_number primary key; xmax = 0
+    # marks rows that were inserted rather than updated. DISTINCT ON keeps the
+    # later row for a repeated company, as writing them one by one did, and
+    # stops ON CONFLICT touching the same row twice.
+    cursor.execute("""
+        WITH upserted AS (
+            INSERT INTO companies_house_data (
+                company_name,
+                company_number,
+                company_status,
+                incorporation_date,
+                scraped_data,
+                scraped_company_type,
+                scraped_incorporation_date,
+                scraped_company_status,
+                scraped_registered_address,
+                scraped_sic_codes,
+                scraped_previous_names,
+                scraped_accounts_due,
+                scraped_confirmation_due,
+                last_scraped_date,
+                scraped_search_name
+            )
+            SELECT DISTINCT ON (company_number)
+                found_name,
+                company_number,
+                company_status,
+                incorporation_date,
+                TRUE,
+                company_type,
+                incorporation_date,
+                company_status,
+                registered_office_address,
+                sic_codes,
+                previous_names,
+                accounts_due,
+                confirmation_due,
+                CURRENT_TIMESTAMP,
+                search_name
+            FROM scraped_raw
+            ORDER BY company_number, seq DESC
+            ON CONFLICT (company_number) DO UPDATE
+            SET 
+                scraped_data = TRUE,
+                scraped_company_type = EXCLUDED.scraped_company_type,
+                scraped_incorporation_date = EXCLUDED.scraped_incorporation_date,
+                scraped_company_status = EXCLUDED.scraped_company_status,
+                scraped_registered_address = EXCLUDED.scraped_registered_address,
+                scraped_sic_codes = EXCLUDED.scraped_sic_codes,
+                scraped_previous_names = EXCLUDED.scraped_previous_names,
+                scraped_accounts_due = EXCLUDED.scraped_accounts_due,
+                scraped_confirmation_due = EXCLUDED.scraped_confirmation_due,
+                last_scraped_date = EXCLUDED.last_scraped_date,
+                scraped_search_name = EXCLUDED.scraped_search_name
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT
+            COUNT(*) FILTER (WHERE NOT inserted),
+            COUNT(*) FILTER (WHERE inserted)
+        FROM upserted
+    """)
+    updated, inserted = cursor.fetchone()
+    
+    return updated, inserted
 
 def attempt_no_match_recovery(cursor):
     """Try to match NO_MATCH records using the enriched scraped data"""
@@ -241,6 +401,76 @@ def attempt_no_match_recovery(cursor):
     print("NO_MATCH recovery not implemented yet - would need to understand table structure")
     return 0
 
+def canonical_header(header):
+    """Map a scraper CSV header ('Company Number' or 'company_number') to one key"""
+    return header.strip().lower().replace(' ', '_')
+
+# Scraper status values as it normally writes them; only other spellings are upper-cased
+_STATUSES = frozenset(('FOUND', 'NOT_FOUND'))
+
+def read_chunks(reader, size):
+    """Yield lists of up to `size` non-blank CSV rows"""
+    chunk = []
+    for cells in reader:
+        if not cells:
+            continue  # skip blank lines
+        chunk.append(cells)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def parse_rows(headers, rows):
+    """Parse a chunk of CSV rows into scraped_raw COPY lines (runs in a worker process).
+    
+    Returns the COPY lines and the found / not found / error counts.
+    """
+    copy_lines = []
+    found_count = 0
+    not_found_count = 0
+    error_count = 0
+    
+    # Pick the INPUT_COLUMNS cells straight out of each row; a column the CSV
+    # lacks reads an empty cell appended to every row
+    width = len(headers)
+    positions = {header: i for i, header in enumerate(headers)}
+    input_cells = itemgetter(*(positions.get(column, width) for column in INPUT_COLUMNS))
+    
+    # Bound once rather than looked up on every row
+    add_line = copy_lines.append
+    join_fields = '\t'.join
+    
+    for cells in rows:
+        if len(cells) != width:
+            cells = (cells + [''] * width)[:width]
+        cells.append('')
+        status, company_number, *fields = input_cells(cells)
+        if status not in _STATUSES:
+            status = status.upper()
+        
+        if status == 'FOUND':
+            found_count += 1
+            
+            # Queue the row for the scraped_raw COPY
+            values = scraped_values(company_number, *fields)
+            if values:
+                add_line(join_fields(map(copy_text_value, values)))
+                
+        elif status == 'NOT_FOUND':
+            not_found_count += 1
+        else:
+            error_count += 1
+    
+    return copy_lines, found_count, not_found_count, error_count
+
+def count_csv_lines(csv_file):
+    """Count data lines in a CSV for the progress bar, reading it in 1MB blocks"""
+    # Quoted multi-line fields make this an upper bound on the row count
+    with open(csv_file, 'rb') as f:
+        lines = sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b''))
+    return max(lines - 1, 0)
+
 def main():
     """Main function to process scraped data"""
     print("=== Update Companies House Data from Scraped Results ===")
@@ -268,9 +498,11 @@ def main():
     # Connect to database
     conn = psycopg2.connect(**POSTGRESQL_CONFIG)
     cursor = conn.cursor()
+    configure_session(cursor)
     
     # Ensure scraped columns exist
     ensure_scraped_columns(cursor)
+    create_staging_table(cursor)
     conn.commit()
     
     # Read CSV and process
@@ -280,58 +512,62 @@ def main():
     found_count = 0
     not_found_count = 0
     error_count = 0
-    companies_updated = 0
-    companies_inserted = 0
-    
-    with open(csv_file, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
-        total_rows = len(rows)
-    
-    print(f"Found {total_rows:,} rows in CSV file\n")
-    
-    with tqdm(total=total_rows, desc="Processing scraped data") as pbar:
-        for row in rows:
-            status = row.get('Status', row.get('status', '')).upper()
+    companies_staged = 0
+    rows_skipped = 0
+    
+    # Stream the rows rather than holding the whole CSV in memory
+    line_count = count_csv_lines(csv_file)
+    print(f"Found {line_count:,} lines in CSV file\n")
+    
+    # Parse chunks in forked workers; the main process only reads and COPYs
+    num_workers = max(1, (os.cpu_count() or 2) - 1)
+    max_pending = num_workers * 2  # chunks in flight, caps memory
+    pending = deque()
+    
+    with open(csv_file, 'r', encoding='utf-8') as f, \
+         multiprocessing.get_context('fork').Pool(num_workers) as pool, \
+         tqdm(total=line_count, desc="Processing scraped data") as pbar:
+        # Normalise the header once; parse_rows maps it to cell positions
+        reader = csv.reader(f)
+        headers = [canonical_header(h) for h in next(reader, [])]
+        chunks = read_chunks(reader, BATCH_SIZE)
+        
+        while True:
+            # Keep the workers fed without reading the whole file ahead
+            for chunk in chunks:
+                pending.append((pool.apply_async(parse_rows, (headers, chunk)), len(chunk)))
+                if len(pending) >= max_pending:
+                    break
             
-            if status == 'FOUND':
-                found_count += 1
-                
-                # Prepare scraped data
-                scraped_data = {
-                    'search_name': row.get('Search Name', ''),
-                    'found_name': row.get('Found Name', ''),
-                    'company_number': row.get('Company Number', ''),
-                    'company_type': row.get('Company Type', ''),
-                    'incorporated_on': row.get('Incorporated On', ''),
-                    'company_status': row.get('Company Status', ''),
-                    'registered_office_address': row.get('Registered Office Address', ''),
-                    'sic_codes': row.get('SIC Codes', ''),
-                    'previous_names': row.get('Previous Names', ''),
-                    'accounts_next_due': row.get('Accounts Next Due', ''),
-                    'confirmation_statement_next_due': row.get('Confirmation Statement Next Due', '')
-                }
-                
-                # Update companies_house_data table
-                result = update_companies_house_data(cursor, scraped_data)
-                if result == 'updated':
-                    companies_updated += 1
-                elif result == 'inserted':
-                    companies_inserted += 1
-                    
-            elif status == 'NOT_FOUND':
-                not_found_count += 1
-            else:
-                error_count += 1
+            if not pending:
+                break
             
-            pbar.update(1)
+            # Collect chunks in file order so scraped_raw.seq follows the CSV
+            result, row_count = pending.popleft()
+            copy_lines, found, not_found, errors = result.get()
+            total_rows += row_count
+            found_count += found
+            not_found_count += not_found
+            error_count += errors
             
-            # Commit every 1000 rows
-            if pbar.n % 1000 == 0:
-                conn.commit()
-    
-    # Final commit
-    conn.commit()
+            staged, skipped = stage_scraped_rows(cursor, copy_lines)
+            companies_staged += staged
+            rows_skipped += skipped
+            # Commit once per staged batch
+            conn.commit()
+            pbar.update(row_count)
+    
+    # Write every staged company at once, then final commit
+    print(f"Writing {companies_staged:,} staged rows to companies_house_data...")
+    try:
+        companies_updated, companies_inserted = update_companies_house_data(cursor)
+        conn.commit()
+    except psycopg2.Error as e:
+        # Report it and carry on to the summary instead of losing it in a traceback
+        conn.rollback()
+        logger.error(f"Error writing staged rows to companies_house_data: {e}")
+        print(f"ERROR: companies_house_data was not updated: {e}")
+        companies_updated = companies_inserted = 0
     
     # Attempt to match NO_MATCH records
     matched_no_match = attempt_no_match_recovery(cursor)
@@ -344,6 +580,7 @@ def main():
     print(f"Found companies: {found_count:,}")
     print(f"Not found: {not_found_count:,}")
     print(f"Errors: {error_count:,}")
+    print(f"Rows skipped (rejected when staged): {rows_skipped:,}")
     print(f"\nDatabase Updates:")
     print(f"Companies updated: {companies_updated:,}")
     print(f"New companies added: {companies_inserted:,}")
@@ -12,6 +12,24 @@ import time
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.postgresql_config import POSTGRESQL_CONFIG
 
+def alter_with_retry(conn, cursor, sql, attempts=100, lock_timeout='200ms', pause=0.5):
+    """Run an ALTER with a short lock_timeout, retrying until it finds a gap
+    between reader transactions instead of queueing (and blocking new readers)
+    behind them. Raises LockNotAvailable once the attempts run out."""
+    for attempt in range(1, attempts + 1):
+        try:
+            # SET LOCAL ends with the ALTER's transaction, so later statements
+            # on this session wait for locks as usual
+            cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            cursor.execute(sql)
+            conn.commit()
+            return attempt
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            if attempt == attempts:
+                raise
+            time.sleep(pause)
+
 def add_columns_fast():
     """Add columns with less aggressive locking"""
     try:
@@ -64,31 +82,58 @@ def add_columns_fast():
         # Add only missing columns
         print("\nAdding missing columns...")
         added_count = 0
+        missing_columns = [(col_name, col_type) for col_name, col_type in columns_to_add
+                           if col_name not in existing_columns]
+        
+        if missing_columns:
+            # One ALTER for every missing column: a single lock acquisition and
+            # catalog update instead of one per column
+            try:
+                print(f"  Adding {len(missing_columns)} columns in one ALTER...", end='', flush=True)
+                start_time = time.time()
+                
+                attempts = alter_with_retry(conn, cursor, "ALTER TABLE land_registry_data " + ", ".join(
+                    f"ADD COLUMN {col_name} {col_type}" for col_name, col_type in missing_columns))
+                
+                elapsed = time.time() - start_time
+                print(f" ✓ Done in {elapsed:.1f}s ({attempts} attempt(s))")
+                added_count = len(missing_columns)
+                missing_columns = []
+                
+            except psycopg2.errors.DuplicateColumn:
+                # Another session added one of them since the check above
+                print(" ✗ DuplicateColumn, falling back to one column at a time")
+                conn.rollback()
+            except psycopg2.errors.LockNotAvailable:
+                # A single-column ALTER needs the same ACCESS EXCLUSIVE lock,
+                # so falling back could not succeed either
+                print(" ✗ Table still locked after retries, no columns added")
+                conn.rollback()
+                conn.close()
+                sys.exit(1)
         
-        for col_name, col_type in columns_to_add:
-            if col_name not in existing_columns:
-                try:
-                    print(f"  Adding {col_name}...", end='', flush=True)
-                    start_time = time.time()
-                    
-                    # Use a shorter lock timeout for the ALTER
-                    cursor.execute("SET lock_timeout = '30s'")
-                    cursor.execute(f"ALTER TABLE land_registry_data ADD COLUMN {col_name} {col_type}")
-                    conn.commit()
-                    
-                    elapsed = time.time() - start_time
-                    print(f" ✓ Done in {elapsed:.1f}s")
-                    added_count += 1
-                    
-                except psycopg2.errors.LockNotAvailable:
-                    print(" ✗ Table locked, skipping")
-                    conn.rollback()
-                except psycopg2.errors.DuplicateColumn:
-                    print(" ✓ Already exists")
-                    conn.rollback()
-                except Exception as e:
-                    print(f" ✗ Error: {e}")
-                    conn.rollback()
+        for col_name, col_type in missing_columns:
+            try:
+                print(f"  Adding {col_name}...", end='', flush=True)
+                start_time = time.time()
+                
+                attempts = alter_with_retry(conn, cursor, f"ALTER TABLE land_registry_data ADD COLUMN {col_name} {col_type}")
+                
+                elapsed = time.time() - start_time
+                print(f" ✓ Done in {elapsed:.1f}s ({attempts} attempt(s))")
+                added_count += 1
+                
+            except psycopg2.errors.LockNotAvailable:
+                print(" ✗ Table still locked after retries, stopping")
+                conn.rollback()
+                conn.close()
+                sys.exit(1)
+            except psycopg2.errors.DuplicateColumn:
+                print(" ✓ Already exists")
+                conn.rollback()
+            except Exception as e:
+                print(f" ✗ Error: {e}")
+                conn.rollback()
         
         if added_count == 0:
             print("\n✅ All columns already exist!")
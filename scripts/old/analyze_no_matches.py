@@ -44,7 +44,24 @@ try:
             COUNT(*) as failed_matches,
             COUNT(CASE WHEN lr.company_1_reg_no IS NOT NULL AND lr.company_1_reg_no <> '' THEN 1 END) as with_reg_no,
             COUNT(CASE WHEN lr.company_1_reg_no IS NULL OR lr.company_1_reg_no = '' THEN 1 END) as without_reg_no,
-            ROUND(COUNT(*) * 100.0 / SUM(COUNT(*)) OVER(), 2) as pct_of_failed
+            ROUND(COUNT(*) * 100.0 / SUM(COUNT(*)) OVER(), 2) as pct_of_failed,
+            -- Name patterns, counted in the same pass over the failed matches
+            COUNT(*) FILTER (WHERE
+                lr.proprietor_1_name LIKE '%SECRETARY OF STATE%' OR
+                lr.proprietor_1_name LIKE '%MINISTER%' OR
+                lr.proprietor_1_name LIKE '%COUNCIL%' OR
+                lr.proprietor_1_name LIKE '%AUTHORITY%' OR
+                lr.proprietor_1_name LIKE '%NHS%' OR
+                lr.proprietor_1_name LIKE '%GOVERNMENT%'
+            ) as gov_count,
+            COUNT(*) FILTER (WHERE lr.proprietor_1_name LIKE '%HOUSING%') as housing_count,
+            COUNT(*) FILTER (WHERE
+                lr.proprietor_1_name LIKE '%(JERSEY)%' OR
+                lr.proprietor_1_name LIKE '%(GUERNSEY)%' OR
+                lr.proprietor_1_name LIKE '%(ISLE OF MAN)%' OR
+                lr.proprietor_1_name LIKE '%(BVI)%' OR
+                lr.proprietor_1_name LIKE '%(CAYMAN%'
+            ) as overseas_count
         FROM land_registry_data lr
         JOIN land_registry_ch_matches m ON lr.id = m.id
         WHERE m.ch_match_type_1 = 'No_Match'
@@ -55,8 +72,12 @@ try:
     print(f"{'Category':<60} | {'Failed':<10} | {'With RegNo':<10} | {'No RegNo':<10} | {'% of Failed':<10}")
     print("-" * 110)
     
+    gov_count = housing_count = overseas_count = 0
     for row in cursor.fetchall():
         print(f"{row['category']:<60} | {row['failed_matches']:>9,} | {row['with_reg_no']:>10,} | {row['without_reg_no']:>9,} | {row['pct_of_failed']:>9.1f}%")
+        gov_count += row['gov_count']
+        housing_count += row['housing_count']
+        overseas_count += row['overseas_count']
     
     # Get some examples from each major category
     print("\n\nEXAMPLE FAILED MATCHES BY CATEGORY:")
@@ -70,24 +91,42 @@ try:
         'Registered Society (Company)'
     ]
     
-    for category in major_categories:
-        print(f"\n{category}:")
-        
-        cursor.execute("""
+    # One pass for every category's examples, drawn from a 1% block sample of
+    # land_registry_data rather than sorting every failed row
+    example_query = """
+        SELECT proprietor_1_name, company_1_reg_no, proprietorship_1_category
+        FROM (
             SELECT 
                 lr.proprietor_1_name,
                 lr.company_1_reg_no,
-                lr.proprietorship_1_category
-            FROM land_registry_data lr
+                lr.proprietorship_1_category,
+                ROW_NUMBER() OVER (PARTITION BY lr.proprietorship_1_category ORDER BY RANDOM()) as rn
+            FROM land_registry_data lr {sample}
             JOIN land_registry_ch_matches m ON lr.id = m.id
             WHERE m.ch_match_type_1 = 'No_Match'
-            AND lr.proprietorship_1_category = %s
-            ORDER BY RANDOM()
-            LIMIT 5
-        """, (category,))
+            AND lr.proprietorship_1_category = ANY(%s)
+        ) sampled
+        WHERE rn <= 5
+    """
+    cursor.execute(example_query.format(sample='TABLESAMPLE SYSTEM (1)'), (major_categories,))
+    
+    examples_by_category = {}
+    for ex in cursor.fetchall():
+        examples_by_category.setdefault(ex['proprietorship_1_category'], []).append(ex)
+    
+    # Categories too rare to fill up from the sample fall back to a full scan
+    short_categories = [c for c in major_categories if len(examples_by_category.get(c, [])) < 5]
+    if short_categories:
+        cursor.execute(example_query.format(sample=''), (short_categories,))
+        for category in short_categories:
+            examples_by_category[category] = []
+        for ex in cursor.fetchall():
+            examples_by_category[ex['proprietorship_1_category']].append(ex)
+    
+    for category in major_categories:
+        print(f"\n{category}:")
         
-        examples = cursor.fetchall()
-        for ex in examples:
+        for ex in examples_by_category.get(category, []):
             reg_no = ex['company_1_reg_no'] or 'None'
             print(f"  - {ex['proprietor_1_name']} (Reg: {reg_no})")
     
@@ -95,53 +134,9 @@ try:
     print("\n\nSPECIFIC PATTERNS IN FAILED MATCHES:")
     print("-" * 100)
     
-    # Government bodies
-    cursor.execute("""
-        SELECT COUNT(*) as count
-        FROM land_registry_data lr
-        JOIN land_registry_ch_matches m ON lr.id = m.id
-        WHERE m.ch_match_type_1 = 'No_Match'
-        AND (
-            lr.proprietor_1_name LIKE '%SECRETARY OF STATE%' OR
-            lr.proprietor_1_name LIKE '%MINISTER%' OR
-            lr.proprietor_1_name LIKE '%COUNCIL%' OR
-            lr.proprietor_1_name LIKE '%AUTHORITY%' OR
-            lr.proprietor_1_name LIKE '%NHS%' OR
-            lr.proprietor_1_name LIKE '%GOVERNMENT%'
-        )
-    """)
-    
-    gov_count = cursor.fetchone()['count']
+    # Counted per category alongside the breakdown above
     print(f"Government/Public bodies: {gov_count:,}")
-    
-    # Housing associations
-    cursor.execute("""
-        SELECT COUNT(*) as count
-        FROM land_registry_data lr
-        JOIN land_registry_ch_matches m ON lr.id = m.id
-        WHERE m.ch_match_type_1 = 'No_Match'
-        AND lr.proprietor_1_name LIKE '%HOUSING%'
-    """)
-    
-    housing_count = cursor.fetchone()['count']
     print(f"Housing-related entities: {housing_count:,}")
-    
-    # Overseas
-    cursor.execute("""
-        SELECT COUNT(*) as count
-        FROM land_registry_data lr
-        JOIN land_registry_ch_matches m ON lr.id = m.id
-        WHERE m.ch_match_type_1 = 'No_Match'
-        AND (
-            lr.proprietor_1_name LIKE '%(JERSEY)%' OR
-            lr.proprietor_1_name LIKE '%(GUERNSEY)%' OR
-            lr.proprietor_1_name LIKE '%(ISLE OF MAN)%' OR
-            lr.proprietor_1_name LIKE '%(BVI)%' OR
-            lr.proprietor_1_name LIKE '%(CAYMAN%'
-        )
-    """)
-    
-    overseas_count = cursor.fetchone()['count']
     print(f"Overseas entities: {overseas_count:,}")
     
     cursor.close()
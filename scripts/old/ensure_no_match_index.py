@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Ensure the partial index on land_registry_ch_matches No_Match rows exists
+
+Run this once before analyze_no_matches.py and analyze_no_regnumber_matches.py;
+those stay read-only and use the index when it is there.
+"""
+
+import sys
+import os
+import psycopg2
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.postgresql_config import POSTGRESQL_CONFIG
+
+def ensure_no_match_index(conn):
+    """Create idx_ch_matches_nomatch if missing (call before opening a transaction)"""
+    # Only the No_Match ids are indexed, so the analysis joins read a small
+    # index and go straight to land_registry_data by id instead of scanning
+    # the whole match table
+    previous = conn.autocommit
+    conn.autocommit = True  # CREATE INDEX CONCURRENTLY can't run in a transaction
+    try:
+        with conn.cursor() as cursor:
+            # An interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index
+            # under the same name, which IF NOT EXISTS would then keep
+            cursor.execute(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+                ('idx_ch_matches_nomatch',)
+            )
+            row = cursor.fetchone()
+            if row and not row[0]:
+                print("Dropping invalid index idx_ch_matches_nomatch to rebuild it...")
+                cursor.execute("DROP INDEX CONCURRENTLY idx_ch_matches_nomatch")
+            
+            cursor.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ch_matches_nomatch
+                ON land_registry_ch_matches(id)
+                WHERE ch_match_type_1 = 'No_Match'
+            """)
+    finally:
+        conn.autocommit = previous
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(**POSTGRESQL_CONFIG)
+    print("Creating partial index on land_registry_ch_matches No_Match rows...")
+    ensure_no_match_index(conn)
+    print("✅ Index created/verified")
+    conn.close()
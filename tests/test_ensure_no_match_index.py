@@ -0,0 +1,69 @@
+"""
+Tests for scripts/old/ensure_no_match_index.py
+"""
+
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+SCRIPT = Path(__file__).parent.parent / "scripts" / "old" / "ensure_no_match_index.py"
+
+@pytest.fixture(scope="module")
+def no_match_index():
+    """Load the script as a module (it lives outside any package)"""
+    spec = importlib.util.spec_from_file_location("ensure_no_match_index", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class IndexCatalogConnection:
+    """Stands in for a connection whose pg_index reports the given validity per index"""
+
+    def __init__(self, validity):
+        self.validity = validity
+        self.autocommit = False
+        self.executed = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.executed.append(" ".join(sql.split()))
+        self.row = (self.validity[params[0]],) if params and params[0] in self.validity else None
+
+    def fetchone(self):
+        return self.row
+
+def statements(conn, prefix):
+    return [sql for sql in conn.executed if sql.startswith(prefix)]
+
+def test_ensure_no_match_index_rebuilds_invalid_index(no_match_index):
+    conn = IndexCatalogConnection({"idx_ch_matches_nomatch": False})
+
+    no_match_index.ensure_no_match_index(conn)
+
+    drops = statements(conn, "DROP INDEX")
+    creates = statements(conn, "CREATE INDEX")
+    assert drops == ["DROP INDEX CONCURRENTLY idx_ch_matches_nomatch"]
+    assert len(creates) == 1
+    assert conn.executed.index(drops[0]) < conn.executed.index(creates[0])
+    assert conn.autocommit is False
+
+@pytest.mark.parametrize("validity", [{"idx_ch_matches_nomatch": True}, {}])
+def test_ensure_no_match_index_keeps_valid_or_missing_index(no_match_index, validity):
+    conn = IndexCatalogConnection(validity)
+
+    no_match_index.ensure_no_match_index(conn)
+
+    assert statements(conn, "DROP INDEX") == []
+    assert len(statements(conn, "CREATE INDEX")) == 1
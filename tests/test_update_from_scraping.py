@@ -0,0 +1,104 @@
+"""
+Tests for the SQL built by scripts/05_update_from_scraping.py
+"""
+
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("tqdm")
+pytest.importorskip("dotenv")
+
+SCRIPT = Path(__file__).parent.parent / "scripts" / "05_update_from_scraping.py"
+
+@pytest.fixture(scope="module")
+def scraping(tmp_path_factory):
+    """Load the script as a module (its name starts with a digit), keeping its log file out of the tree"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("logs"))
+    try:
+        spec = importlib.util.spec_from_file_location("update_from_scraping", SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+@pytest.mark.parametrize("slot", [1, 2, 3, 4])
+def test_match_slot_update_sql_renders_slot(scraping, slot):
+    sql = scraping.match_slot_update_sql(slot)
+
+    assert "{" not in sql and "}" not in sql
+    assert f"ch_matched_name_{slot} = s.found_name" in sql
+    assert f"ch_match_type_{slot} = 'Scraped'" in sql
+    assert f"ch_match_confidence_{slot} = 0.8" in sql
+    assert f"m.ch_matched_number_{slot} = s.company_number" in sql
+    assert f"m.ch_match_type_{slot} = 'Land_Registry'" in sql
+
+    # Only this slot's columns are touched
+    for other in {1, 2, 3, 4} - {slot}:
+        assert f"_{other} " not in sql
+
+class RejectingCursor:
+    """Stands in for a cursor whose COPY fails on any batch containing a rejected line"""
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+        self.copied = []
+
+    def execute(self, sql):
+        pass
+
+    def copy_expert(self, sql, data):
+        lines = data.getvalue().splitlines()
+        if self.rejected & set(lines):
+            raise ValueError("value too long for type character varying(20)")
+        self.copied.extend(lines)
+
+def test_stage_scraped_rows_skips_only_rejected_rows(scraping):
+    lines = [f"row{i}" for i in range(10)]
+    cursor = RejectingCursor({"row3", "row7"})
+
+    staged, skipped = scraping.stage_scraped_rows(cursor, lines)
+
+    assert (staged, skipped) == (8, 2)
+    assert cursor.copied == [line for line in lines if line not in {"row3", "row7"}]
+
+class IndexCatalogConnection:
+    """Stands in for a connection whose pg_index reports the given validity per index"""
+
+    def __init__(self, validity):
+        self.validity = validity
+        self.autocommit = False
+        self.executed = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.executed.append(" ".join(sql.split()))
+        self.row = (self.validity[params[0]],) if params and params[0] in self.validity else None
+
+    def fetchone(self):
+        return self.row
+
+def test_ensure_match_slot_indexes_rebuilds_invalid_index(scraping):
+    conn = IndexCatalogConnection({"idx_lrchm_slot1_lr": True, "idx_lrchm_slot2_lr": False})
+
+    scraping.ensure_match_slot_indexes(conn)
+
+    drops = [sql for sql in conn.executed if sql.startswith("DROP INDEX")]
+    creates = [sql for sql in conn.executed if sql.startswith("CREATE INDEX")]
+    assert drops == ["DROP INDEX CONCURRENTLY idx_lrchm_slot2_lr"]
+    assert len(creates) == 4
+    assert conn.executed.index(drops[0]) < conn.executed.index(creates[1])
+    assert conn.autocommit is False